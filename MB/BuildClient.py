@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# coding=utf-8
+from urllib.parse import quote
+import http.client
+import json
+import os
+import socket
+import time
+
+SERVICE_PORT = 8765  # Default TCP port of the build service (it only listens on localhost unless told otherwise)
+
+
+class ServiceError(Exception):
+    """Error answered by the build service, with its HTTP status"""
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTP connection through a Unix socket"""
+    def __init__(self, socket_path, timeout=None):
+        http.client.HTTPConnection.__init__(self, "localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class BuildClient(object):
+    """Client of a BuildService (see MBservice.py), through TCP (host, port) or a Unix socket (socket_path). Each
+    method is one request and returns the decoded answer, or raises a ServiceError:
+        client = BuildClient(socket_path="mb.sock")
+        client.create_session("virus", "examples/enterovirus/")
+        job = client.submit("virus", num_models=5, max_chains=120, seed=1)
+        status = client.wait(job["id"])
+        client.download(job["id"], status["files"][0])"""
+    def __init__(self, host="127.0.0.1", port=SERVICE_PORT, socket_path=None, timeout=None):
+        self.host = host
+        self.port = port
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    def request(self, method, path, body=None, raw=False):
+        """Sends a request and returns the decoded JSON answer (or its bytes with raw)"""
+        if self.socket_path:
+            connection = UnixHTTPConnection(self.socket_path, self.timeout)
+        else:
+            connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            headers = {"Content-Type": "application/json"} if body is not None else {}
+            connection.request(method, path, None if body is None else json.dumps(body), headers)
+            response = connection.getresponse()
+            content = response.read()
+        finally:
+            connection.close()
+        if response.status >= 400:
+            try:
+                message = json.loads(content.decode("utf-8"))["error"]
+            except (ValueError, KeyError):
+                message = content.decode("utf-8", "replace")
+            raise ServiceError(response.status, message)
+        return content if raw else json.loads(content.decode("utf-8"))
+
+    def create_session(self, name, directory, **options):
+        """Loads an input directory of the service's machine as a session, options are interface_rmsd and jobs"""
+        return self.request("POST", "/sessions", dict(options, name=name, directory=directory))
+
+    def sessions(self):
+        return self.request("GET", "/sessions")
+
+    def session(self, name):
+        return self.request("GET", "/sessions/" + quote(name, safe=""))
+
+    def remove_session(self, name):
+        return self.request("DELETE", "/sessions/" + quote(name, safe=""))
+
+    def submit(self, session, output="macrocomplex", **parameters):
+        """Queues a build against a session and returns its status. The parameters are the
+        BuildSettings listed in JOB_PARAMETERS (num_models, max_chains, stech_string, seed, top...)"""
+        return self.request("POST", "/jobs", dict(parameters, session=session, output=output))
+
+    def jobs(self):
+        return self.request("GET", "/jobs")
+
+    def status(self, job_id):
+        return self.request("GET", "/jobs/" + quote(job_id, safe=""))
+
+    def cancel(self, job_id):
+        return self.request("POST", "/jobs/" + quote(job_id, safe="") + "/cancel")
+
+    def remove_job(self, job_id):
+        return self.request("DELETE", "/jobs/" + quote(job_id, safe=""))
+
+    def wait(self, job_id, interval=0.5, timeout=None):
+        """Returns the status of a job once it is not queued or running (None if timeout seconds pass before)"""
+        start = time.perf_counter()
+        while True:
+            status = self.status(job_id)
+            if status["status"] not in ("queued", "running"):
+                return status
+            if timeout is not None and time.perf_counter() - start >= timeout:
+                return None
+            time.sleep(interval)
+
+    def download(self, job_id, name, path=None):
+        """Saves a result file of a job (as name in the working directory if no path is given) and returns its path"""
+        content = self.request("GET", "/jobs/" + quote(job_id, safe="") + "/files/" + quote(name, safe=""), raw=True)
+        path = path or os.path.basename(name)
+        with open(path, "wb") as fh:
+            fh.write(content)
+        return path
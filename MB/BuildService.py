@@ -0,0 +1,380 @@
+#!/usr/bin/env python
+# coding=utf-8
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, unquote
+import json
+import os
+import queue
+import shutil
+import socketserver
+import threading
+import time
+import uuid
+from MB.MacroB import prepare_inputs, build_models, get_string_stech_dict, INTERFACE_RMSD
+from MB.BuildSettings import BuildSettings
+from MB.Frontier import FRONTIER_ORDERS
+from MB.Progress import ProgressEvents
+from MB.BuildClient import SERVICE_PORT
+
+SERVICE_RESULTS = "MB_service"  # Default directory of the results, one subdirectory for each job
+# Parameters of a build job (the BuildSettings of the same name) and their JSON types, bools and numbers are not mixed
+JOB_PARAMETERS = {"num_models": int, "max_chains": int, "stech_string": str, "template": str, "seed": int,
+                  "order": str, "symmetry": bool, "top": int, "time_budget": float,
+                  "max_failures": int, "compress": bool, "jobs": int, "score": bool}
+
+
+class JobProgress(ProgressEvents):
+    """Progress of a service job. Nobody drains its events, so instead of queueing them it keeps the counters shown
+    by the job status: the current stage, the finished models and the chains of the model being built"""
+    def __init__(self):
+        ProgressEvents.__init__(self)
+        self.stage = None
+        self.model = None
+        self.chains = 0
+        self.models_finished = 0
+
+    def emit(self, kind, **data):
+        if kind == "stage":
+            self.stage = data["name"]
+        elif kind == "model_started":
+            self.model = data["model"]
+            self.chains = len(data["macrocomplex"])
+        elif kind == "chain_added":
+            self.chains += 1
+        elif kind == "model_finished":
+            self.models_finished += 1
+
+
+class Session(object):
+    """Input directory loaded once: its sequence dictionary and interaction graph, shared by all the jobs that use
+    it (builds only read them)"""
+    def __init__(self, name, directory, seq_dict, interaction_graph, seconds):
+        self.name = name
+        self.directory = directory
+        self.seq_dict = seq_dict
+        self.interaction_graph = interaction_graph
+        self.seconds = seconds
+
+    def to_dict(self):
+        return {"name": self.name,
+                "directory": self.directory,
+                "chains": len(set(self.seq_dict.values())),
+                "templates": len(self.interaction_graph.chains),
+                "interactions": len(self.interaction_graph),
+                "seconds": self.seconds}
+
+
+class BuildJob(object):
+    """A build requested to the service: its session, parameters, state (queued, running, finished, cancelled or
+    failed), progress and, once finished, the scores of the saved models, best first (if the job asked for them with
+    score or top)"""
+    def __init__(self, job_id, session, parameters, output, directory):
+        self.id = job_id
+        self.session = session
+        self.parameters = parameters
+        self.output = output
+        self.directory = directory
+        self.status = "queued"
+        self.progress = JobProgress()
+        self.scores = None
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+
+    def to_dict(self):
+        files = sorted(os.listdir(self.directory)) if os.path.isdir(self.directory) else []
+        return {"id": self.id,
+                "session": self.session.name,
+                "parameters": self.parameters,
+                "status": self.status,
+                "stage": self.progress.stage,
+                "model": self.progress.model,
+                "chains": self.progress.chains,
+                "models_finished": self.progress.models_finished,
+                "scores": self.scores,
+                "files": [name for name in files if not name.endswith(".tmp")],
+                "error": self.error,
+                "submitted": self.submitted,
+                "started": self.started,
+                "finished": self.finished}
+
+
+def get_job_parameters(parameters):
+    """Returns the parameters of a build job converted to their types, raising ValueError if any is unknown or
+    wrong"""
+    job_parameters = dict()
+    for name, value in parameters.items():
+        if name not in JOB_PARAMETERS:
+            raise ValueError("Unknown job parameter %s, it must be one of %s" % (name,
+                                                                                   ", ".join(sorted(JOB_PARAMETERS))))
+        if value is None:
+            continue
+        kind = JOB_PARAMETERS[name]
+        if kind is float and isinstance(value, int) and not isinstance(value, bool):
+            value = float(value)  # JSON numbers without decimals
+        if type(value) is not kind:  # Only real JSON booleans are bools, and they are not numbers
+            raise ValueError("Wrong value of the job parameter %s: %s" % (name, json.dumps(value)))
+        job_parameters[name] = value
+    if job_parameters.get("order", "fifo") not in FRONTIER_ORDERS:
+        raise ValueError("Unknown frontier order %s, it must be one of %s" % (job_parameters["order"],
+                                                                              ", ".join(FRONTIER_ORDERS)))
+    for name in ("num_models", "max_chains", "top", "max_failures", "jobs"):
+        if job_parameters.get(name, 1) < 1:
+            raise ValueError("The job parameter %s must be at least 1" % name)
+    if "stech_string" in job_parameters:
+        try:  # It writes the error and exits, as in the command line
+            get_string_stech_dict(job_parameters["stech_string"])
+        except SystemExit:
+            raise ValueError("Wrong stoichiometry string %s" % job_parameters["stech_string"])
+    if "template" in job_parameters and not os.path.isfile(job_parameters["template"]):
+        raise ValueError("Template %s doesn't exist" % job_parameters["template"])
+    return job_parameters
+
+
+class BuildService(object):
+    """Long running builder: input directories are loaded once into named sessions (see prepare_inputs) and any
+    number of build jobs with different parameters are run against them, without reading the inputs again. Jobs wait
+    in a queue taken by worker threads, each job saves its models and scores in its own directory of results_dir,
+    and can be followed, cancelled (the finished models are still saved, as in the GUI) and removed."""
+    def __init__(self, results_dir=SERVICE_RESULTS, workers=1, verbose=False, use_cache=True):
+        self.results_dir = os.path.abspath(results_dir)
+        self.verbose = verbose
+        self.use_cache = use_cache
+        self.sessions = dict()  # Name: Session
+        self.jobs = dict()  # Id: BuildJob, in the order they were submitted
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        os.makedirs(self.results_dir, exist_ok=True)
+        self.workers = [threading.Thread(target=self.work, daemon=True) for _ in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def create_session(self, name, directory, interface_rmsd=INTERFACE_RMSD, jobs=1):
+        """Loads an input directory as a session (replacing the one with the same name) and returns its description"""
+        if not name or "/" in name:
+            raise ValueError("Wrong session name %s" % name)
+        if not os.path.isdir(directory):
+            raise ValueError("Directory %s doesn't exist" % directory)
+        directory = os.path.join(os.path.abspath(directory), "")  # The input directories end with /
+        start = time.perf_counter()
+        try:  # It writes the error and exits, as in the command line
+            seq_dict, interaction_graph = prepare_inputs(directory, self.verbose, int(jobs), self.use_cache,
+                                                         float(interface_rmsd))
+        except SystemExit:
+            raise ValueError("The input files of %s couldn't be read, see the service log" % directory)
+        session = Session(name, directory, seq_dict, interaction_graph, time.perf_counter() - start)
+        with self.lock:
+            self.sessions[name] = session
+        return session.to_dict()
+
+    def get_session(self, name):
+        with self.lock:
+            if name not in self.sessions:
+                raise KeyError("There is no session %s" % name)
+            return self.sessions[name]
+
+    def remove_session(self, name):
+        """Forgets a session, the jobs already submitted still use it"""
+        session = self.get_session(name)
+        with self.lock:
+            del self.sessions[name]
+        return session.to_dict()
+
+    def submit(self, session_name, output="macrocomplex", **parameters):
+        """Queues a build job against a session and returns its status"""
+        session = self.get_session(session_name)
+        output = os.path.basename(output)
+        if not output:
+            raise ValueError("Wrong output name")
+        job_id = uuid.uuid4().hex[:12]
+        job = BuildJob(job_id, session, get_job_parameters(parameters), output, os.path.join(self.results_dir, job_id))
+        os.makedirs(job.directory)
+        with self.lock:
+            self.jobs[job_id] = job
+        self.queue.put(job)
+        return job.to_dict()
+
+    def get_job(self, job_id):
+        with self.lock:
+            if job_id not in self.jobs:
+                raise KeyError("There is no job %s" % job_id)
+            return self.jobs[job_id]
+
+    def cancel(self, job_id):
+        """Cancels a job: a queued one is not run, and a running one stops at the next chain"""
+        job = self.get_job(job_id)
+        if job.status == "queued":
+            job.status = "cancelled"
+            job.finished = time.time()
+        elif job.status == "running":
+            job.progress.cancel()
+        return job.to_dict()
+
+    def remove_job(self, job_id):
+        """Forgets a job that is not queued or running, and deletes its results"""
+        job = self.get_job(job_id)
+        if job.status in ("queued", "running"):
+            raise ValueError("Job %s is %s, cancel it first" % (job_id, job.status))
+        with self.lock:
+            del self.jobs[job_id]
+        shutil.rmtree(job.directory, ignore_errors=True)
+        return job.to_dict()
+
+    def get_file_path(self, job_id, name):
+        """Returns the path of a result file of a job"""
+        path = os.path.join(self.get_job(job_id).directory, os.path.basename(name))
+        if not os.path.isfile(path):
+            raise KeyError("Job %s has no file %s" % (job_id, name))
+        return path
+
+    def work(self):
+        """Runs the queued jobs, until it gets None"""
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            if job.status != "queued":  # Cancelled while it waited
+                continue
+            job.status = "running"
+            job.started = time.time()
+            try:
+                settings = BuildSettings(os.path.join(job.directory, job.output), verbose=self.verbose,
+                                         **job.parameters)
+                scores = build_models(job.session.interaction_graph, job.session.seq_dict, settings,
+                                      progress=job.progress)
+                if scores is not None:
+                    job.scores = [{name: value.item() if hasattr(value, "item") else value  # Plain numbers, for JSON
+                                   for name, value in score.items()} for score in scores]
+                job.status = "cancelled" if job.progress.cancelled else "finished"
+            except SystemExit:  # Errors of the build are written to stderr before exiting, as in the command line
+                job.status = "failed"
+                job.error = "The build stopped with an error, see the service log"
+            except Exception as error:
+                job.status = "failed"
+                job.error = "%s: %s" % (type(error).__name__, error)
+            job.finished = time.time()
+
+    def shutdown(self):
+        """Cancels the running jobs and stops the workers"""
+        with self.lock:
+            jobs = list(self.jobs.values())
+        for job in jobs:
+            if job.status in ("queued", "running"):
+                self.cancel(job.id)
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    """JSON API of a BuildService (the server's service attribute):
+        GET /sessions, GET /sessions/NAME: the loaded sessions
+        POST /sessions {"name", "directory", "interface_rmsd", "jobs"}: loads an input directory
+        DELETE /sessions/NAME: forgets a session
+        GET /jobs, GET /jobs/ID: status of the jobs
+        POST /jobs {"session", "output", parameters of JOB_PARAMETERS}: queues a build
+        POST /jobs/ID/cancel: cancels a job
+        DELETE /jobs/ID: removes a finished job and its results
+        GET /jobs/ID/files/NAME: downloads a result file (models, scores)
+    Errors are answered as {"error": message}, with status 400 (wrong request) or 404 (unknown session, job or file)"""
+    def address_string(self):
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "local"  # Unix sockets
+
+    def log_message(self, format, *args):
+        if self.server.service.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def send_json(self, value, status=200):
+        content = json.dumps(value).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def send_file(self, path):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(os.path.getsize(path)))
+        self.end_headers()
+        with open(path, "rb") as fh:
+            shutil.copyfileobj(fh, self.wfile)
+
+    def read_json(self):
+        content = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            value = json.loads(content.decode("utf-8")) if content else dict()
+        except ValueError:
+            raise ValueError("The request body is not valid JSON")
+        if not isinstance(value, dict):
+            raise ValueError("The request body must be a JSON object")
+        return value
+
+    def handle_request(self, method):
+        service = self.server.service
+        parts = [unquote(part) for part in urlparse(self.path).path.split("/") if part]
+        try:
+            if parts == ["sessions"] and method == "GET":
+                with service.lock:
+                    sessions = list(service.sessions.values())
+                return self.send_json([session.to_dict() for session in sessions])
+            if parts == ["sessions"] and method == "POST":
+                body = self.read_json()
+                if "name" not in body or "directory" not in body:
+                    raise ValueError("A session needs a name and a directory")
+                return self.send_json(service.create_session(**body), 201)
+            if len(parts) == 2 and parts[0] == "sessions" and method == "GET":
+                return self.send_json(service.get_session(parts[1]).to_dict())
+            if len(parts) == 2 and parts[0] == "sessions" and method == "DELETE":
+                return self.send_json(service.remove_session(parts[1]))
+            if parts == ["jobs"] and method == "GET":
+                with service.lock:
+                    jobs = list(service.jobs.values())
+                return self.send_json([job.to_dict() for job in jobs])
+            if parts == ["jobs"] and method == "POST":
+                body = self.read_json()
+                if "session" not in body:
+                    raise ValueError("A job needs a session")
+                return self.send_json(service.submit(body.pop("session"), **body), 202)
+            if len(parts) == 2 and parts[0] == "jobs" and method == "GET":
+                return self.send_json(service.get_job(parts[1]).to_dict())
+            if len(parts) == 2 and parts[0] == "jobs" and method == "DELETE":
+                return self.send_json(service.remove_job(parts[1]))
+            if len(parts) == 3 and parts[0] == "jobs" and parts[2] == "cancel" and method == "POST":
+                return self.send_json(service.cancel(parts[1]))
+            if len(parts) == 4 and parts[0] == "jobs" and parts[2] == "files" and method == "GET":
+                return self.send_file(service.get_file_path(parts[1], parts[3]))
+            raise KeyError("Unknown request %s %s" % (method, self.path))
+        except KeyError as error:
+            self.send_json({"error": error.args[0]}, 404)
+        except (ValueError, TypeError) as error:
+            self.send_json({"error": str(error)}, 400)
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_DELETE(self):
+        self.handle_request("DELETE")
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """HTTP server on a Unix socket, only reachable by the users that can open the socket file"""
+    daemon_threads = True
+
+
+def make_server(service, host="127.0.0.1", port=SERVICE_PORT, socket_path=None):
+    """Returns the HTTP server of a BuildService, on a Unix socket if socket_path is given or on host:port otherwise.
+    Each request is handled by its own thread, so the status can be asked while jobs run"""
+    if socket_path:
+        if os.path.exists(socket_path):  # Left by a previous service
+            os.remove(socket_path)
+        server = UnixHTTPServer(socket_path, ServiceHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), ServiceHandler)
+    server.service = service
+    return server
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+# Settings that change the models a seed gives, so a build can only be resumed with the same ones
+MODEL_SETTINGS = ("max_chains", "dirty", "order", "symmetry", "max_failures")
+
+
+class BuildSettings(object):
+    """Options of a build, as given in the command line (see MBlauncher.py -h and the README for what each one does).
+    It is made once by the launcher, the GUI or a service job and passed to every step of the build, also to the
+    worker processes, so adding an option doesn't change any signature."""
+    def __init__(self, output="macrocomplex", num_models=1, max_chains=300, template=False, stech_string=False,
+                 dirty=False, verbose=False, jobs=1, seed=None, compress=False, order="fifo", symmetry=False,
+                 score=False, top=None, checkpoint=False, resume=False, time_budget=None, max_failures=None,
+                 profile_file=None):
+        self.output = output  # Name of the output files, without extension (it can be a path)
+        self.num_models = num_models
+        self.max_chains = max_chains
+        self.template = template  # Pdb file whose stoichiometry is used, and that scores the models
+        self.stech_string = stech_string  # Stoichiometry as A:2,B:4 (if there is no template)
+        self.dirty = dirty  # Logs each model's trajectory
+        self.verbose = verbose
+        self.jobs = jobs  # Processes that build and save the models
+        self.seed = seed  # Seed of the first model, a random one if None
+        self.compress = compress
+        self.order = order  # Order of the frontier (see Frontier)
+        self.symmetry = symmetry
+        self.score = score
+        self.top = top  # Number of best ranked models saved, all if None
+        self.checkpoint = checkpoint
+        self.resume = resume
+        self.time_budget = time_budget  # Seconds per model
+        self.max_failures = max_failures  # Candidates rejected in a row that stop a model
+        self.profile_file = profile_file
+
+    def to_dict(self):
+        return dict(vars(self))
+
+    def get_model_settings(self):
+        """Returns the settings that change the models (MODEL_SETTINGS) as a dictionary"""
+        return {name: getattr(self, name) for name in MODEL_SETTINGS}
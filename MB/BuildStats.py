@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# coding=utf-8
+import contextlib
+import json
+import time
+
+
+class BuildStats(object):
+    """Instrumentation of a build: wall time of each pipeline stage, counters of the hot paths of the modeling loop
+    and the timing of each model. The functions that fill it take it as an optional argument and only check it is not
+    None, so a build without stats doesn't pay for them."""
+    def __init__(self):
+        self.stages = dict()  # Stage name: seconds
+        self.counters = dict()  # Counter name: value
+        self.models = []  # One dictionary for each built model
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Context manager that adds the wall time of its block to the given stage"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_model(self, model_id, seed, seconds, chains):
+        self.models.append({"model": model_id, "seed": seed, "seconds": seconds, "chains": chains})
+
+    def merge(self, other):
+        """Adds the counters and models of another BuildStats or of its to_dict (as sent back by worker processes)"""
+        if isinstance(other, BuildStats):
+            other = other.to_dict()
+        for name, seconds in other["stages"].items():
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+        for name, value in other["counters"].items():
+            self.count(name, value)
+        self.models.extend(other["models"])
+
+    def to_dict(self):
+        return {"stages": dict(self.stages),
+                "total": sum(self.stages.values()),
+                "counters": dict(self.counters),
+                "models": sorted(self.models, key=lambda x: x["model"])}
+
+    def save(self, path):
+        """Writes the stats as a JSON file"""
+        with open(path, "w") as fh:
+            json.dump(self.to_dict(), fh, indent=2)
+
+
+def timed_stage(stats, name, progress=None):
+    """Returns a context manager timing a stage in stats, or one that does nothing if stats is None. If a
+    ProgressEvents is given, the start of the stage is sent to it"""
+    if progress:
+        progress.emit("stage", name=name)
+    if stats is None:
+        return contextlib.nullcontext()
+    return stats.stage(name)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# coding=utf-8
+import json
+import os
+import pickle
+import time
+from MB.CustomPDB import ChainPlacement, MacroComplex
+from MB.Frontier import Frontier
+from MB.Symmetry import SymmetryDetector
+
+CHECKPOINT_VERSION = 1
+CHECKPOINT_INTERVAL = 30.0  # Minimum seconds between two checkpoints of the same model
+
+
+def get_build_checkpoint_path(output):
+    """Returns the path of the checkpoint of a build: its seed and the settings that must not change to resume it"""
+    return output + "_checkpoint.json"
+
+
+def get_model_checkpoint_path(output, i):
+    """Returns the path of the checkpoint of the model number i of a build"""
+    return output + str(i) + "_checkpoint.pkl"
+
+
+def save_build_checkpoint(output, header):
+    """Writes the checkpoint of a build as JSON"""
+    with open(get_build_checkpoint_path(output), "w") as fh:
+        json.dump(dict(header, version=CHECKPOINT_VERSION), fh, indent=2)
+
+
+def read_build_checkpoint(output):
+    """Returns the checkpoint of a build, or None if it is missing, damaged or from another version"""
+    try:
+        with open(get_build_checkpoint_path(output)) as fh:
+            header = json.load(fh)
+    except (OSError, ValueError):
+        return None
+    return header if header.get("version") == CHECKPOINT_VERSION else None
+
+
+def read_checkpoint(path):
+    """Returns the state saved in a model checkpoint, or None if it is missing, damaged or from another version"""
+    try:
+        with open(path, "rb") as fh:
+            state = pickle.load(fh)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+    return state if state.get("version") == CHECKPOINT_VERSION else None
+
+
+def remove_checkpoints(output, num_models):
+    """Deletes the checkpoints of a finished build"""
+    paths = [get_build_checkpoint_path(output)] + [get_model_checkpoint_path(output, i)
+                                                   for i in range(1, num_models + 1)]
+    for path in paths + [path + ".tmp" for path in paths[1:]]:  # Also the ones of a build killed while writing
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class CheckpointWriter(object):
+    """Saves the state of a model every interval seconds. The builder asks if a checkpoint is due between two chains
+    (a clock read), so the build only pays for the checkpoints it writes. Each one is a pickle of some small arrays and
+    lists that replaces the previous one with an atomic rename, so a build killed while writing keeps the last one."""
+    def __init__(self, path, interval=CHECKPOINT_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.last = time.perf_counter()
+
+    def due(self):
+        return time.perf_counter() - self.last >= self.interval
+
+    def save(self, state):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as fh:
+            pickle.dump(state, fh, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path)
+        self.last = time.perf_counter()
+
+
+def get_model_state(macrocomplex, template_index, frontier, model_stech, stech_dict, rng, detector=None,
+                    trajectory=None, seconds=0.0, finished=False, failures=0):
+    """Returns the state of a model between two chains of the frontier: each placed chain as (template number,
+    rotation, translation) and the interactions it still has to try, the frontier (as chain numbers), the stoichiometry
+    counters, the candidates rejected in a row, the state of the random generator and the symmetry operators found.
+    The copies of the symmetry detector are the placed chains, in the same order, so they are not saved."""
+    if frontier.order == "most":
+        items = [(key, pushed, placement.number) for key, pushed, placement in frontier.items]
+    else:
+        items = [placement.number for placement in frontier.items]
+    return {"version": CHECKPOINT_VERSION,
+            "model": macrocomplex.id,
+            "placements": [(template_index[id(placement.template)], placement.rot, placement.tran)
+                           for placement in macrocomplex],
+            "interactions": {placement.number: placement.interactions for placement in macrocomplex
+                             if placement.interactions},
+            "frontier": items,
+            "pushed": frontier.pushed,
+            "model_stech": dict(model_stech),
+            "stech_dict": dict(stech_dict) if stech_dict else stech_dict,
+            "rng": rng.getstate(),
+            "symmetry": None if detector is None else (detector.counts, detector.operators),
+            "trajectory_steps": trajectory.steps if trajectory else None,
+            "seconds": seconds,
+            "failures": failures,
+            "finished": finished}
+
+
+def restore_model_state(state, templates, rng, order="fifo"):
+    """Rebuilds the macrocomplex, the frontier and the symmetry detector (None if there wasn't any) of a state
+    returned by get_model_state, and sets the random generator to its state. templates are the template chains by
+    number (interaction_graph.chains)."""
+    macrocomplex = MacroComplex(state["model"])
+    for number, (template_number, rot, tran) in enumerate(state["placements"]):
+        placement = ChainPlacement(templates[template_number], rot, tran)
+        placement.interactions = list(state["interactions"].get(number, []))
+        macrocomplex.add(placement)
+    rng.setstate(state["rng"])
+    frontier = Frontier(order, rng)
+    placements = macrocomplex.placements
+    if order == "most":  # Already a heap
+        frontier.items = [(key, pushed, placements[number]) for key, pushed, number in state["frontier"]]
+    else:
+        frontier.items = type(frontier.items)(placements[number] for number in state["frontier"])
+    frontier.pushed = state["pushed"]
+    detector = None
+    if state["symmetry"] is not None:
+        detector = SymmetryDetector()
+        detector.counts, detector.operators = state["symmetry"]
+        for placement in macrocomplex:
+            detector.add(placement)
+    return macrocomplex, frontier, detector
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# coding=utf-8
+import gzip
+import sys
+
+ATOM_SITE_FIELDS = ["group_PDB", "id", "type_symbol", "label_atom_id", "label_alt_id", "label_comp_id",
+                    "label_asym_id", "label_entity_id", "label_seq_id", "pdbx_PDB_ins_code", "Cartn_x", "Cartn_y",
+                    "Cartn_z", "occupancy", "B_iso_or_equiv", "auth_seq_id", "auth_asym_id", "pdbx_PDB_model_num"]
+
+
+def format_value(value):
+    """Returns a value ready to be written in a CIF row, quoted when needed (the rules of biopython's MMCIFIO)"""
+    value = str(value)
+    if not value:
+        return "?"
+    if "\n" in value or ("' " in value and '" ' in value):  # Quotes can't hold it, semicolon lines are needed
+        return "\n;" + value + "\n;\n"
+    if (" " in value or "\t" in value or "'" in value or '"' in value or value[0] in "_#$[];"
+            or value.lower().startswith(("data_", "save_")) or value.lower() in ("loop_", "stop_", "global_")):
+        return '"' + value + '"' if "' " in value else "'" + value + "'"
+    return value
+
+
+def get_label_asym_id(entity_id):
+    """Converts a positive integer into a chain label: A to Z, then AA to ZA, AB to ZB... (like biopython's MMCIFIO)"""
+    out = ""
+    while entity_id > 0:
+        mod = (entity_id - 1) % 26
+        out += chr(65 + mod)
+        entity_id = (entity_id - mod) // 26
+    return out
+
+
+def get_atom_site_template(chain):
+    """Returns the static part of the _atom_site rows of a chain's atoms, in get_atoms order. Each atom is a tuple
+    (group, text before label_asym_id, text between label_asym_id and the coordinates, text after the coordinates,
+    entity number inside the chain), with the names already quoted. It is stored in the chain's xtra, as all the
+    copies of a template share it"""
+    if "atom_site" in chain.xtra:
+        return chain.xtra["atom_site"]
+    rows = []
+    residue_number = 1
+    entity = 0
+    prev_residue_type = ""
+    prev_resname = ""
+    for residue in chain:
+        hetfield, resseq, icode = residue.get_id()
+        if hetfield == " ":
+            residue_type = "ATOM"
+            label_seq_id = str(residue_number)
+            residue_number += 1
+        else:
+            residue_type = "HETATM"
+            label_seq_id = "."
+        if icode == " ":
+            icode = "?"
+        resname = residue.get_resname().strip()
+        if residue_type != prev_residue_type or (residue_type == "HETATM" and resname != prev_resname):
+            entity += 1  # A new molecule starts (a new label_asym_id)
+        prev_residue_type = residue_type
+        prev_resname = resname
+        for atom in residue:
+            element = atom.element.strip() or "?"
+            altloc = atom.get_altloc()
+            if altloc == " ":
+                altloc = "."
+            rows.append((residue_type,
+                         " ".join(format_value(value) for value in (element, atom.get_name().strip(), altloc,
+                                                                     resname)),
+                         "? %s %s" % (label_seq_id, format_value(icode)),
+                         "%s %s %s" % (atom.get_occupancy(), atom.get_bfactor(), resseq),
+                         entity))
+    chain.xtra["atom_site"] = rows
+    return rows
+
+
+def write_mmCIF(macrocomplex, out_file, compress=False):
+    """Writes a macrocomplex (a list of ChainPlacement) in mmCIF format. The _atom_site rows are written chain by chain
+    straight from the placed coordinate arrays, so memory use doesn't grow with the size of the model. If compress
+    is True, the file is gzipped."""
+    model_id = str(macrocomplex.id)
+    for c in ["#", "$", "'", '"', "[", "]", " ", "\t", "\n"]:  # Data block names can't have special characters
+        model_id = model_id.replace(c, "")
+    if compress:
+        fh = gzip.open(out_file, "wt", compresslevel=6)  # Much faster than the default 9, files barely bigger
+    else:
+        fh = open(out_file, "w")
+    with fh:
+        fh.write("data_%s\n#\nloop_\n" % model_id)
+        fh.write("".join("_atom_site.%s\n" % field for field in ATOM_SITE_FIELDS))
+        atom_number = 1
+        entity_base = 0
+        for placement in macrocomplex:
+            rows = get_atom_site_template(placement.template)
+            coords = placement.get_coord_array()
+            chain_id = format_value(placement.id)
+            labels = dict()  # Entity number inside the chain: label_asym_id
+            lines = []
+            for (group, before, middle, after, entity), (x, y, z) in zip(rows, coords.tolist()):
+                if entity not in labels:
+                    labels[entity] = get_label_asym_id(entity_base + entity)
+                lines.append("%s %d %s %s %s %.3f %.3f %.3f %s %s 1\n" % (group, atom_number, before, labels[entity],
+                                                                        middle, x, y, z, after, chain_id))
+                atom_number += 1
+            if rows:
+                entity_base += rows[-1][4]
+            fh.write("".join(lines))
+        fh.write("#\n")
+
+
+def save_mmCIF(macrocomplex, out_name, compress=False):
+    """Saves a macrocomplex using the given output name (adding .cif or .cif.gz)"""
+    out_file = out_name + (".cif.gz" if compress else ".cif")
+    try:
+        write_mmCIF(macrocomplex, out_file, compress)
+        print(out_file + " saved")
+    except OSError:
+        sys.stderr.write("Couldn't save models to current working directory. "
+                         "Make sure you have permission to write files")
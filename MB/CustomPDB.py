@@ -3,8 +3,18 @@
 from Bio.PDB.Structure import Structure
 from Bio.PDB.Model import Model
 from Bio.PDB.Chain import Chain
-import Bio.PDB.NeighborSearch
-import sys
+from Bio.PDB.Residue import Residue
+from Bio.PDB.Atom import Atom
+from MB.SpatialGrid import close_pairs, SpatialHash, PoseIndex
+from MB.CifWriter import save_mmCIF
+import numpy as np
+
+CONTACT_DISTANCE = 3.5  # Maximum distance (in Angstroms) between two atoms to consider them interacting
+CLASH_DISTANCE = 2  # Maximum distance (in Angstroms) between two backbone atoms to consider them clashing
+BACKBONE_ATOMS = {"CA", "C1\'"}  # Atoms used to look for clashes (protein and nucleic acid backbones)
+POSE_DISTANCE = 2  # Maximum distance (in Angstroms) between the centers of two chains with the same pose
+POSE_COSINE = 0.94  # Minimum cosine (about 20 degrees) between the orientation axes of two chains with the same pose
+
 
 class CustomModel(Model):
     """Custom biopython model class that allows models with more than one same id"""
@@ -13,21 +23,11 @@ class CustomModel(Model):
         entity.set_parent(self)
         self.child_list.append(entity)
 
-    def save_to_mmCIF(self, out_name):
-        """Saves a model using the given output name in the cwd"""
-        io = Bio.PDB.MMCIFIO()
-        io.set_structure(self)
-        try:
-            io.save(out_name+".cif")
-            print(out_name+".cif saved")
-        except:
-            sys.stderr.write("Couldn't save models to current working directory. "
-                             "Make sure you have permission to write files")
-
 
 class CustomChain(Chain):
     """Custom biopython's chain class with more flexibilty. The most important difference is the new attribute
-    interactions, a list of interacting residues that is crucial for the macrocomplex building."""
+    interactions, the list of interactions (edges of the InteractionGraph) that is crucial for the macrocomplex
+    building."""
     protein = {'CYS': 'C', 'ASP': 'D', 'SER': 'S', 'GLN': 'Q', 'LYS': 'K',
                'ILE': 'I', 'PRO': 'P', 'THR': 'T', 'PHE': 'F', 'ASN': 'N',
                'GLY': 'G', 'HIS': 'H', 'LEU': 'L', 'ARG': 'R', 'TRP': 'W',
@@ -39,33 +39,72 @@ class CustomChain(Chain):
         self.child_list = chainObject.child_list
         self._id = chainObject._id
         self.parent = chainObject.parent
-        self.interactions = []  # Here there will be stored the chain's known interactions as tuple of residues
+        self.interactions = []  # Here there will be stored the chain's known interactions as graph edges
         self.xtra = chainObject.xtra
         self.level = chainObject.level
         # The other attibutes are needed for biopython to be able to work.
 
     def add_interaction_lst(self, lst):
-        """Sets the interactions attribute to a list of interaction tuples"""
+        """Sets the interactions attribute to a list of interaction edges"""
         self.interactions = lst
 
+    def get_backbone_coords(self):
+        """Returns an array with the coordinates of the chain's backbone atoms"""
+        if "backbone" not in self.xtra:  # Indices of the backbone atoms in the coordinate array
+            self.xtra["backbone"] = np.array([i for i, atom in enumerate(self.get_atoms()) if atom.id in BACKBONE_ATOMS],
+                                             dtype=np.int64)
+        return self.get_coord_array()[self.xtra["backbone"]]
+
+    def get_bounding_sphere(self):
+        """Returns the center and the radius of a sphere that contains all the chain's backbone atoms"""
+        if "sphere" not in self.xtra:
+            backbone = self.get_backbone_coords()
+            if len(backbone):
+                center = backbone.mean(axis=0)
+                radius = float(np.sqrt(((backbone - center) ** 2).sum(axis=1).max()))
+            else:
+                center, radius = np.zeros(3), 0.0
+            self.xtra["sphere"] = (center, radius)
+        return self.xtra["sphere"]
+
+    def get_pose_axes(self):
+        """Returns the orientation of the chain as two unit vectors, from the center of its backbone to its first and
+        to its last backbone atoms"""
+        if "axes" not in self.xtra:
+            backbone = self.get_backbone_coords()
+            axes = np.zeros((2, 3))
+            if len(backbone) > 1:
+                axes = backbone[[0, -1]] - self.get_bounding_sphere()[0]
+                axes /= np.maximum(np.linalg.norm(axes, axis=1), 1e-9)[:, None]
+            self.xtra["axes"] = axes
+        return self.xtra["axes"]
+
+    def get_atom_arrays(self):
+        """Returns an array with the coordinates of the chain's atoms and another one with their residue numbers"""
+        coords = []
+        res_numbers = []
+        for residue in self:
+            res_number = residue.id[1]
+            for atom in residue:
+                coords.append(atom.coord)
+                res_numbers.append(res_number)
+        return np.array(coords, dtype=np.float64).reshape(-1, 3), np.array(res_numbers, dtype=np.int64)
+
     def get_interactions(self, other_chain):
         """Compares the distance between the atoms of two chains and returns a tuple (chain1, chain2) of
         interaction tuples (2,34,50...)"""
-        atom_list_1 = list(self.get_atoms())
-        atom_list_2 = list(other_chain.get_atoms())
-        ns = Bio.PDB.NeighborSearch(atom_list_2)  # Generates a neighbour search tree to speed up distance calculations
-        interaction_res_1 = set()
-        interaction_res_2 = set()
-        for atom in atom_list_1:
-            inter_atoms = ns.search(atom.coord, 3.5)  # List of atoms closer than 3.5 A than the given atom
-            if len(inter_atoms) > 0:  # If there is interacting atoms:
-                interaction_res_1.add(atom.get_parent().id[1])  # Add the corresponding atom's residue to the set
-                for iatom in inter_atoms:
-                    interaction_res_2.add(iatom.get_parent().id[1]) # Same for the other interacting atoms
-        return tuple(sorted(interaction_res_1)), tuple(sorted(interaction_res_2))  # Transform to tuples and return
+        coords_1, res_numbers_1 = self.get_atom_arrays()
+        coords_2, res_numbers_2 = other_chain.get_atom_arrays()
+        # Pairs of atoms closer than 3.5 A (close_pairs returns nothing at once if the chains' boxes don't touch)
+        index_1, index_2 = close_pairs(coords_1, coords_2, CONTACT_DISTANCE)
+        interaction_res_1 = tuple(int(x) for x in np.unique(res_numbers_1[index_1]))  # Sorted residue numbers
+        interaction_res_2 = tuple(int(x) for x in np.unique(res_numbers_2[index_2]))
+        return interaction_res_1, interaction_res_2
 
     def get_sequence(self):
         """Returns the chain's sequence, it can be a protein, DNA or RNA sequence"""
+        if "sequence" in self.xtra:  # Already computed when the chain was read (see read_pdbs)
+            return self.xtra["sequence"]
         seq = ""
         flag = "prot"
         first_residue_name = self.child_list[0].resname.strip()  # Get the first residue name to see what kind
@@ -89,16 +128,189 @@ class CustomChain(Chain):
                     seq += self.rna[res.resname.strip()]
         return seq
 
-    def get_common_atoms(self, other):
-        """Compares the list of atoms of two chains and returns an even tuple of atoms"""
-        self_atoms = sorted(self.get_atoms())  # Generates a sorted list of atoms to be able to compare them
-        other_atoms = sorted(other.get_atoms())
-        len_self = len(self_atoms)
-        len_other = len(other_atoms)
-        # Return the atom list sliced by the limitant distance
-        if len_self > len_other:
-            return self_atoms[:len_other], other_atoms
-        elif len_other > len_self:
-            return self_atoms, other_atoms[:len_self]
-        else: # If they are equal, just return the atoms lists
-            return self_atoms, other_atoms
+    def get_coord_array(self):
+        """Returns an array with the coordinates of all the chain's atoms, in get_atoms order. It is kept in xtra, so
+        whoever moves the chain's atoms has to update it"""
+        if "coords" not in self.xtra:
+            self.xtra["coords"] = np.array([atom.coord for atom in self.get_atoms()], dtype=np.float64).reshape(-1, 3)
+        return self.xtra["coords"]
+
+    def get_common_atom_indices(self, other):
+        """Returns two arrays with the indices (in each chain's coordinate array) of the atoms that both chains have.
+        It uses the correspondence index built by unify_ids, so the residues of homologous chains are paired even if
+        they have insertions or missing residues. Without it, it pairs the sorted atoms up to the shortest
+        chain"""
+        if "correspondence" in self.xtra and "correspondence" in other.xtra:
+            self_corr = self.xtra["correspondence"]
+            other_corr = other.xtra["correspondence"]
+            if len(self_corr) == len(other_corr):  # Both are aligned to the same reference chain
+                common = (self_corr >= 0) & (other_corr >= 0)
+                if common.sum() >= 3:
+                    return self_corr[common], other_corr[common]
+        self_atoms = list(self.get_atoms())
+        other_atoms = list(other.get_atoms())
+        self_order = sorted(range(len(self_atoms)), key=lambda i: self_atoms[i])
+        other_order = sorted(range(len(other_atoms)), key=lambda i: other_atoms[i])
+        length = min(len(self_order), len(other_order))  # Slices by the limitant length
+        return np.array(self_order[:length], dtype=np.int64), np.array(other_order[:length], dtype=np.int64)
+
+
+class ChainPlacement(object):
+    """A chain of a macrocomplex, represented by its template (a CustomChain of the input pairs) and the rotation and
+    translation that put it in place: its coordinates are template @ rot + tran. Its atoms are only written when the
+    model is saved, so rejected candidates and placed chains cost a couple of small matrices."""
+    def __init__(self, template, rot=None, tran=None):
+        self.template = template
+        self.rot = np.identity(3) if rot is None else rot
+        self.tran = np.zeros(3) if tran is None else tran
+        self.interactions = list(template.interactions)  # Interactions still to be tried from this chain
+        self.parent = None
+        self.number = None
+        self.sphere = None  # Placed bounding sphere and orientation axes, computed once (a placement never moves)
+        self.axes = None
+
+    @property
+    def id(self):
+        return self.template.id
+
+    def get_coord_array(self):
+        """Returns the placed coordinates of all the chain's atoms"""
+        return np.dot(self.template.get_coord_array(), self.rot) + self.tran
+
+    def get_backbone_coords(self):
+        """Returns the placed coordinates of the chain's backbone atoms"""
+        return np.dot(self.template.get_backbone_coords(), self.rot) + self.tran
+
+    def get_bounding_sphere(self):
+        """Returns the center and the radius of the placed chain's backbone bounding sphere"""
+        if self.sphere is None:
+            center, radius = self.template.get_bounding_sphere()
+            self.sphere = np.dot(center, self.rot) + self.tran, radius
+        return self.sphere
+
+    def get_pose_axes(self):
+        """Returns the orientation axes of the placed chain"""
+        if self.axes is None:
+            self.axes = np.dot(self.template.get_pose_axes(), self.rot)
+        return self.axes
+
+
+class MacroComplex(object):
+    """Macrocomplex being built, a list of ChainPlacement objects. It keeps a spatial hash of its backbone atoms and
+    the bounding sphere of each chain, both updated each time a chain is added, to look for clashes, and an index of
+    the chains' poses to find duplicated chains."""
+    def __init__(self, id):
+        self.id = id
+        self.placements = []
+        self.backbone_index = SpatialHash(CLASH_DISTANCE)
+        self.backbone_starts = [0]  # Position of each placement's backbone atoms in the spatial hash, and the end
+        self.centers = np.zeros((0, 3), dtype=np.float64)  # Bounding sphere of each placement (with extra room)
+        self.radii = np.zeros(0, dtype=np.float64)
+        self.poses = PoseIndex(POSE_DISTANCE, POSE_COSINE)
+
+    def __iter__(self):
+        return iter(self.placements)
+
+    def __len__(self):
+        return len(self.placements)
+
+    def add(self, placement, backbone_coords=None):
+        """Adds a placed chain to the macrocomplex (with its placed backbone coordinates, if they are already known)"""
+        placement.parent = self
+        placement.number = len(self.placements)  # Position of the chain in the macrocomplex
+        self.placements.append(placement)
+        if backbone_coords is None:
+            backbone_coords = placement.get_backbone_coords()
+        self.backbone_index.add(backbone_coords)
+        self.backbone_starts.append(len(self.backbone_index))
+        if len(self.placements) > len(self.radii):  # Doubles the storage, so adding chains is amortized O(1)
+            size = max(16, 2 * len(self.radii))
+            self.centers = np.concatenate([self.centers, np.zeros((size - len(self.radii), 3))])
+            self.radii = np.concatenate([self.radii, np.zeros(size - len(self.radii))])
+        self.centers[placement.number], self.radii[placement.number] = placement.get_bounding_sphere()
+        self.poses.add(placement.id, placement.get_bounding_sphere()[0], placement.get_pose_axes(), placement)
+
+    def get_backbone_index(self):
+        """Returns the spatial hash of the macrocomplex's backbone atoms"""
+        return self.backbone_index
+
+    def get_backbone_coords(self, number=None):
+        """Returns the placed coordinates of the backbone atoms of all the chains (in order), or of the chain number,
+        as they are stored in the spatial hash"""
+        coords = self.backbone_index.coords
+        if number is None:
+            return coords[:len(self.backbone_index)]
+        return coords[self.backbone_starts[number]:self.backbone_starts[number + 1]]
+
+    def find_duplicate(self, placement):
+        """Returns the placed chain with the same id and pose as the given placement, or None if there isn't any"""
+        return self.poses.find(placement.id, placement.get_bounding_sphere()[0], placement.get_pose_axes())
+
+    def get_spheres(self):
+        """Returns the centers and radii of the bounding spheres of all the placed chains"""
+        return self.centers[:len(self.placements)], self.radii[:len(self.placements)]
+
+    def get_near_spheres(self, center, radius):
+        """Returns the centers and radii of the bounding spheres of the placed chains that are at most radius away
+        from the given center, without counting their own radius"""
+        centers, radii = self.get_spheres()
+        near = ((centers - center) ** 2).sum(axis=1) <= (radii + radius) ** 2
+        return centers[near], radii[near]
+
+    def save_to_mmCIF(self, out_name, compress=False):
+        """Saves the macrocomplex using the given output name in the cwd. Atoms are streamed from the placed
+        coordinates, without building the biopython model"""
+        save_mmCIF(self, out_name, compress)
+
+def compact_chain(chain):
+    """Packs a chain into a plain record (lists and numpy arrays) that is cheap to send between processes. Only the
+    selected conformation of disordered atoms and residues is kept."""
+    residues = []
+    atom_residue = []
+    names, fullnames, altlocs, elements, serials = [], [], [], [], []
+    coords, bfactors, occupancies = [], [], []
+    for res_index, residue in enumerate(chain):
+        hetflag, resseq, icode = residue.id
+        residues.append((hetflag, resseq, icode, residue.resname, residue.segid))
+        for atom in residue:
+            atom_residue.append(res_index)
+            names.append(atom.name)
+            fullnames.append(atom.fullname)
+            altlocs.append(atom.altloc)
+            elements.append(atom.element)
+            serials.append(atom.serial_number)
+            coords.append(atom.coord)
+            bfactors.append(atom.bfactor)
+            occupancies.append(atom.occupancy)
+    return {"id": chain.id,
+            "residues": residues,
+            "atom_residue": np.array(atom_residue, dtype=np.int32),
+            "names": names,
+            "fullnames": fullnames,
+            "altlocs": altlocs,
+            "elements": elements,
+            "serials": serials,
+            "coords": np.array(coords, dtype=np.float32).reshape(-1, 3),
+            "bfactors": np.array(bfactors, dtype=np.float64),  # float32 would print as 47.88999938964844
+            "occupancies": np.array(occupancies, dtype=np.float64)}
+
+
+def expand_chain(record):
+    """Rebuilds a biopython Chain from a record generated by compact_chain"""
+    chain = Chain(record["id"])
+    residues = []
+    for hetflag, resseq, icode, resname, segid in record["residues"]:
+        residue = Residue((hetflag, resseq, icode), resname, segid)
+        chain.add(residue)
+        residues.append(residue)
+    coords = record["coords"].copy()  # Each atom keeps a view of this array
+    bfactors = record["bfactors"].tolist()
+    occupancies = record["occupancies"].tolist()
+    for i, res_index in enumerate(record["atom_residue"].tolist()):
+        atom = Atom(record["names"][i], coords[i], bfactors[i], occupancies[i], record["altlocs"][i],
+                    record["fullnames"][i], record["serials"][i], record["elements"][i])
+        residue = residues[res_index]
+        atom.parent = residue  # Filled directly, the record comes from an already valid chain
+        residue.child_list.append(atom)
+        residue.child_dict[atom.id] = atom
+    return chain
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# coding=utf-8
+from collections import deque
+import heapq
+
+FRONTIER_ORDERS = ("fifo", "most", "random")
+
+
+class Frontier(object):
+    """Work queue of the placed chains that still have interactions to try. The order in which they are taken can be
+    fifo (breadth first, in the order they were placed), most (the chain with more pending interactions first, the
+    oldest one on ties) or random (using the given random.Random, so it is reproducible with the model's seed). Each
+    push and pop is O(1) or O(log n), so a model costs time proportional to the placements tried."""
+    def __init__(self, order="fifo", rng=None):
+        if order not in FRONTIER_ORDERS:
+            raise ValueError("Unknown frontier order %s, it must be one of %s" % (order, ", ".join(FRONTIER_ORDERS)))
+        self.order = order
+        self.rng = rng
+        self.items = deque() if order == "fifo" else []
+        self.pushed = 0  # Number of chains pushed, breaks the ties of the heap
+
+    def __len__(self):
+        return len(self.items)
+
+    def push(self, placement):
+        if self.order == "most":
+            heapq.heappush(self.items, (-len(placement.interactions), self.pushed, placement))
+        else:
+            self.items.append(placement)
+        self.pushed += 1
+
+    def pop(self):
+        if self.order == "fifo":
+            return self.items.popleft()
+        if self.order == "most":
+            return heapq.heappop(self.items)[2]
+        index = self.rng.randrange(len(self.items))  # Random: swaps the chosen one with the last one
+        self.items[index], self.items[-1] = self.items[-1], self.items[index]
+        return self.items.pop()
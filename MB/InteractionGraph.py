@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# coding=utf-8
+import numpy as np
+
+
+class InteractionGraph(object):
+    """Indexed form of the interaction dictionary. Each interaction is an edge with an integer index, in the order of
+    the dictionary: the chain that is superimposed (source), the chain that is added (target), the id of the added
+    chain, the interacting residues of the source (the key of the dictionary) and the index of the reverse edge (-1 if
+    the reverse interaction was overwritten by another one with the same residues). Template chains are numbered in
+    the order they first appear, and each chain id has the array of its edges. The interactions attribute of each
+    template chain gets the edges it can still try: all the edges of its id except its own interaction."""
+    def __init__(self, interaction_dict):
+        self.chains = []  # Template chains, by number
+        numbers = dict()  # id(chain): number
+        sources, targets = [], []
+        self.target_ids = []
+        self.keys = []
+        self.adjacency = dict()  # Chain id: array of edge indices
+        edge_index = dict()  # (chain id, residues): edge index
+        own_keys = dict()  # Chain number: its interacting residues (its own interaction)
+        for chain_id in interaction_dict:
+            edges = []
+            for key, (fix, to_move, ref_inter) in interaction_dict[chain_id].items():
+                for chain in (fix, to_move):
+                    if id(chain) not in numbers:
+                        numbers[id(chain)] = len(self.chains)
+                        self.chains.append(chain)
+                edge_index[(chain_id, key)] = len(self.keys)
+                edges.append(len(self.keys))
+                sources.append(numbers[id(fix)])
+                targets.append(numbers[id(to_move)])
+                self.target_ids.append(to_move.id)
+                self.keys.append(key)
+                own_keys[numbers[id(fix)]] = key
+                own_keys[numbers[id(to_move)]] = ref_inter
+            self.adjacency[chain_id] = np.array(edges, dtype=np.int64)
+        self.sources = np.array(sources, dtype=np.int64)
+        self.targets = np.array(targets, dtype=np.int64)
+        self.reverse = np.full(len(self.keys), -1, dtype=np.int64)
+        for edge in range(len(self.keys)):
+            fix, to_move = self.chains[self.sources[edge]], self.chains[self.targets[edge]]
+            reverse = edge_index.get((to_move.id, own_keys[self.targets[edge]]))
+            if reverse is not None and self.sources[reverse] == self.targets[edge] \
+                    and self.targets[reverse] == self.sources[edge]:
+                self.reverse[edge] = reverse
+        for number, chain in enumerate(self.chains):
+            own_edge = edge_index.get((chain.id, own_keys[number]))
+            chain.add_interaction_lst([edge for edge in self.adjacency[chain.id].tolist() if edge != own_edge])
+
+    def __len__(self):
+        return len(self.keys)
+
+    def get_chains(self, edge):
+        """Returns the (source, target) template chains of an edge"""
+        return self.chains[self.sources[edge]], self.chains[self.targets[edge]]
+
+    def get_interacting_ids(self):
+        """Returns the set of (chain id, chain id) pairs that interact, in both orders"""
+        pairs = set()
+        for source, target_id in zip(self.sources.tolist(), self.target_ids):
+            pairs.add((self.chains[source].id, target_id))
+            pairs.add((target_id, self.chains[source].id))
+        return pairs
+
+    def get_starting_chains(self):
+        """Returns the two chains of the first interaction of the chain id with more interactions. They are ordered
+        as the last edge read between them, so the same seed keeps giving the same models"""
+        chain_id = max(self.adjacency, key=lambda x: len(self.adjacency[x]))  # First one of the maximum
+        edge = self.adjacency[chain_id][0]
+        fix, to_move = self.get_chains(edge)
+        if self.reverse[edge] > edge:  # The reverse interaction is the last one read of the pair
+            return [to_move, fix]
+        return [fix, to_move]
@@ -4,22 +4,42 @@ from tkinter import *
 from tkinter import filedialog
 from tkinter import messagebox
 from MB.MacroB import *
+from MB.BuildSettings import BuildSettings
+from MB.BuildStats import BuildStats
+from MB.Progress import ProgressEvents
+from MB.Thumbnail import get_thumbnail_data, THUMBNAIL_SIZE
+import queue
 import sys
 import os
 import threading
+import time
+
+POLL_INTERVAL = 100  # Milliseconds between two updates of the GUI with the output and the events of the build
+CONSOLE_LINES = 2000  # Lines kept in the console widget
+PREVIEW_INTERVAL = 0.5  # Seconds between two previews of the model being built
 
 
 class StdRedirector():
-    """Class that redirects the stdout and stderr to the GUI console"""
-    def __init__(self, text_widget):
-        self.text_space = text_widget
+    """Class that redirects the stdout and stderr to the GUI console. Any thread can write, the text is only queued
+    and the GUI thread adds it to the console in batches"""
+    def __init__(self):
+        self.lines = queue.Queue()
 
     def write(self, string):
-        """Updates the console widget with the stdout and stderr output"""
-        self.text_space.config(state=NORMAL)
-        self.text_space.insert("end", string)
-        self.text_space.see("end")
-        self.text_space.config(state=DISABLED)
+        """Queues the stdout and stderr output"""
+        self.lines.put(string)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        """Returns all the queued text"""
+        text = []
+        while True:
+            try:
+                text.append(self.lines.get_nowait())
+            except queue.Empty:
+                return "".join(text)
 
 class MB(Frame):
     def show_about(self):
@@ -76,8 +96,11 @@ class MB(Frame):
         label_num_models = Label(frame, text="Number of models")
         label_current_dir = Label(frame, text="Selected directory:")
         label_current_dir_path = Label(frame, textvariable=directory)
-        self.label_dirty = Checkbutton(frame, text="dirty mode (generates tmp files)", onvalue=True, offvalue=False, variable=dirty)
+        self.label_dirty = Checkbutton(frame, text="Trajectory (replay it with MBreplay.py)", onvalue=True, offvalue=False,
+                                       variable=dirty)
         self.label_verbose = Checkbutton(frame, text="Verbose (Show all steps)", onvalue=True, offvalue=False, variable=verbose)
+        self.label_score = Checkbutton(frame, text="Score and rank the models", onvalue=True, offvalue=False,
+                                       variable=score)
         label_template = Label(frame, text="Stechiometry by template (Optional)")
         entry_template = Button(frame, text="Browse", command=self.get_template)
         clear_template = Button(frame, text="Clear", command=self.clear_template)
@@ -87,6 +110,7 @@ class MB(Frame):
         self.entry_max_chains = Spinbox(frame, from_=100, to=1000)
         self.entry_num_models = Spinbox(frame, from_=1, to=100)
         self.entry_run = Button(frame, text="RUN", command=self.thread_MB)
+        self.entry_cancel = Button(frame, text="CANCEL", command=self.cancel_MB, state='disabled')
         label_stech = Label(frame, text="Stechiometry by string (Optional)")
         entry_label_stech = Entry(frame, textvariable=stech_string)
         label_stech.grid(row=5, column=0, sticky="w")
@@ -101,10 +125,12 @@ class MB(Frame):
         self.entry_num_models.grid(row=3, column=1, sticky="w")
         self.label_dirty.grid(row=1, column=2, sticky="w", columnspan=3)
         self.label_verbose.grid(row=2, column=2, sticky="w", columnspan=3)
+        self.label_score.grid(row=3, column=2, sticky="w", columnspan=3)
         label_template.grid(row=4, column=0, sticky="w")
         entry_template.grid(row=4, column=1, sticky="w")
         label_template_path.grid(row=4, column=2)
         self.entry_run.grid(row=2, column=6, sticky="w")
+        self.entry_cancel.grid(row=3, column=6, sticky="w")
         frame.grid(row=0)
 
     def create_sequence_dict(self):
@@ -159,22 +185,96 @@ class MB(Frame):
         scrollbar.grid(row=0,column=1, stick="ns")
         scrollbar.config(command=self.console.yview)
         self.console.grid(row=0,column=0, stick="ns")
-        sys.stdout = StdRedirector(self.console)
-        sys.stderr = StdRedirector(self.console)
+        self.redirector = StdRedirector()
+        sys.stdout = self.redirector
+        sys.stderr = self.redirector
+        label_progress = Label(frame, textvariable=self.progress_text, justify=LEFT, anchor="w")
+        label_progress.grid(row=1, column=0, columnspan=2, sticky="we")
         frame.grid(row=0)
 
-    def update_image(self):
-        """Updates the image widget with the first macrocomplex model"""
-        try:
-            cwd = os.getcwd()
-            best_model_name = cwd +"/"+ output_name.get()+"_1.cif"
-            image_name = "%s/%s.png" % (cwd,output_name.get()+"_1")
-            os.system("pymol %s -c -d 'hide all;show ribbon;util.cbc;png %s, width=300, height=300'" % (best_model_name, image_name))
-            image = PhotoImage(file=image_name)
-            self.model_image.create_image(150, 150, anchor=CENTER, image=image)
-            self.model_image.image = image
-        except:
-            sys.stderr.write("Pymol couldn't create the image. Please, check if pymol is installed")
+    def reset_counters(self):
+        """Sets the counters of the build progress to zero"""
+        self.counters = {"stage": "", "models": 0, "added": 0, "clash": 0, "duplicate": 0, "stoichiometry": 0}
+        self.update_counters()
+
+    def update_counters(self):
+        """Shows the counters of the build progress"""
+        self.progress_text.set("Stage: %(stage)s   Models: %(models)s   Chains added: %(added)s\n"
+                               "Rejected by clashes: %(clash)s   duplicates: %(duplicate)s   "
+                               "stoichiometry: %(stoichiometry)s" % self.counters)
+
+    def handle_event(self, kind, data):
+        """Updates the GUI with an event of the build"""
+        if kind == "stage":
+            self.counters["stage"] = data["name"]
+        elif kind == "model_started":
+            self.building = data["macrocomplex"]
+        elif kind == "chain_added":
+            self.counters["added"] += 1
+            self.preview_pending = True
+        elif kind == "chain_rejected":
+            self.counters[data["reason"]] += 1
+        elif kind == "model_finished":
+            self.counters["models"] += 1
+            if not self.models:  # The composition of the first model is shown until the build ends
+                self.update_estequiometry(data["macrocomplex"])
+            self.models[data["macrocomplex"].id] = data["macrocomplex"]
+            self.add_preview(data["macrocomplex"])
+        elif kind == "sequences":
+            self.update_seq_dict()
+        elif kind == "composition":
+            self.update_estequiometry(self.models[data["model"]])
+            self.preview_name.set(data["model"])
+            self.select_preview()
+        elif kind == "finished":
+            self.counters["stage"] = "cancelled" if self.progress.cancelled else "finished"
+            self.entry_run.config(state='normal')
+            self.entry_cancel.config(state='disabled')
+
+    def poll(self):
+        """Adds the queued output to the console and handles the queued events of the build, in batches, so the
+        GUI keeps responding whatever the build prints"""
+        text = self.redirector.drain()
+        if text:
+            self.console.config(state=NORMAL)
+            self.console.insert("end", text)
+            lines = int(self.console.index("end-1c").split(".")[0])
+            if lines > CONSOLE_LINES:  # Old lines are removed, so the console doesn't grow without limit
+                self.console.delete(1.0, "%s.0" % (lines - CONSOLE_LINES))
+            self.console.see("end")
+            self.console.config(state=DISABLED)
+        if self.progress:
+            events = self.progress.drain()
+            for kind, data in events:
+                self.handle_event(kind, data)
+            if events:
+                self.update_counters()
+            if self.preview_pending and self.building is not None and \
+                    time.monotonic() - self.preview_time > PREVIEW_INTERVAL:  # Preview of the model being built
+                self.show_image(PhotoImage(data=get_thumbnail_data(self.building)))
+                self.preview_pending = False
+                self.preview_time = time.monotonic()
+        self.after(POLL_INTERVAL, self.poll)
+
+    def show_image(self, image):
+        """Updates the image widget with a model preview"""
+        self.model_image.delete("all")
+        self.model_image.create_image(THUMBNAIL_SIZE // 2, THUMBNAIL_SIZE // 2, anchor=CENTER, image=image)
+        self.model_image.image = image
+
+    def add_preview(self, macrocomplex):
+        """Renders the preview of a finished model, shows it and adds it to the ones that can be selected"""
+        self.previews[macrocomplex.id] = PhotoImage(data=get_thumbnail_data(macrocomplex))
+        self.building = None
+        self.preview_pending = False
+        self.entry_preview.config(values=list(self.previews))
+        self.preview_name.set(macrocomplex.id)
+        self.show_image(self.previews[macrocomplex.id])
+
+    def select_preview(self):
+        """Shows the preview of the selected model"""
+        if self.preview_name.get() in self.previews:
+            self.show_image(self.previews[self.preview_name.get()])
 
     def create_image(self):
         """Generates the image label"""
@@ -185,8 +285,11 @@ class MB(Frame):
     def create_image_frame(self):
         """Generates the image frame"""
         frame = Frame(self.image_frame)
-        self.model_image = Canvas(frame, width=300, height=300, background="black")
+        self.model_image = Canvas(frame, width=THUMBNAIL_SIZE, height=THUMBNAIL_SIZE, background="black")
         self.model_image.pack()
+        self.entry_preview = Spinbox(frame, values=(), textvariable=self.preview_name, command=self.select_preview,
+                                     state="readonly")
+        self.entry_preview.pack()
         frame.grid(row=0, column=1)
 
 
@@ -201,27 +304,33 @@ class MB(Frame):
 
 
     def run_MB(self):
-        """Using MacroB functions, builds the macrocomplex"""
-        self.in_pdbmodels = read_pdbs(directory.get()+"/", verbose.get())
-        if self.in_pdbmodels:
-            self.seq_dict = unify_ids(self.in_pdbmodels)
-            self.interaction_dict = get_interaction_dict(self.in_pdbmodels, verbose.get())
-            self.update_seq_dict()
-            update_interactions_dict(self.interaction_dict, verbose)
-            self.stech_dict = None
-            if template_path.get() != "":
-                self.stech_dict = get_template_stech_dict(template_path.get(), self.seq_dict, verbose=verbose)
-            elif stech_string.get():
-                self.stech_dict = get_string_stech_dict(stech_string.get())
-            out_pdbmodels = main_loop(int(self.entry_num_models.get()), output_name.get(), self.interaction_dict, verbose.get(),
-                                      int(self.entry_max_chains.get()), dirty.get(), self.stech_dict)
-            self.update_estequiometry(out_pdbmodels[0])
-            save_results(out_pdbmodels, output_name.get())
-            self.update_image()
-        else:
-            sys.stderr.write("No valid input PDB given in %s/ directory. Please, inputs should be "
-                             "pdbs that contain only 2 chains interacting" % directory.get())
-        self.entry_run.config(state='normal')
+        """Builds the macrocomplex with the functions of the command line (prepare_inputs and build_models). It runs
+        in its own thread, so the widgets are only updated by the GUI thread, through the progress events"""
+        progress = self.progress
+        stats = BuildStats()
+        try:
+            self.seq_dict, self.interaction_graph = prepare_inputs(directory.get() + "/", verbose.get(), stats=stats,
+                                                                   progress=progress)
+            progress.emit("sequences")
+            settings = BuildSettings(output_name.get(), int(self.entry_num_models.get()),
+                                     int(self.entry_max_chains.get()), template=template_path.get() or False,
+                                     stech_string=stech_string.get() or False, dirty=dirty.get(),
+                                     verbose=verbose.get(), score=score.get())
+            scores = build_models(self.interaction_graph, self.seq_dict, settings, stats, progress)
+            if scores:  # The composition of the best ranked model, instead of the first one
+                progress.emit("composition", model=scores[0]["model"])
+            print("Time of each stage: " + ", ".join("%s %.2f s" % (name, seconds)
+                                                     for name, seconds in stats.stages.items()))
+        except SystemExit:  # The error was written to the console before exiting, as in the command line
+            pass
+        finally:
+            progress.emit("finished")
+
+    def cancel_MB(self):
+        """Asks the running build to stop after the current chain"""
+        if self.progress:
+            self.progress.cancel()
+            self.entry_cancel.config(state='disabled')
 
     def thread_MB(self):
         """Starts a new thread to run the modeling apart from the GUI"""
@@ -236,10 +345,18 @@ class MB(Frame):
             self.seq_listbox.delete(1.0, END)
             self.seq_listbox.config(state=DISABLED)
             self.model_image.delete("all")
-            self.entry_run.config(state='disabled')
             if template_path.get() and stech_string.get():
                 sys.stderr.write("For stechometry, select only one of the options, not both.")
             else:
+                self.entry_run.config(state='disabled')
+                self.entry_cancel.config(state='normal')
+                self.progress = ProgressEvents()  # A new channel for each build
+                self.previews = dict()
+                self.models = dict()
+                self.building = None
+                self.preview_name.set("")
+                self.entry_preview.config(values=())
+                self.reset_counters()
                 t = threading.Thread(target=self.run_MB)
                 t.daemon = True # close pipe if GUI process exits
                 t.start()
@@ -273,7 +390,17 @@ class MB(Frame):
         self.master.resizable(width=True, height=True)
         self.master.grid_rowconfigure(0, weight=1)
         self.master.grid_columnconfigure(0, weight=1)
+        self.progress = None  # ProgressEvents of the running (or last) build
+        self.progress_text = StringVar()
+        self.preview_name = StringVar()
+        self.previews = dict()  # Model id: PhotoImage of the preview of each finished model
+        self.models = dict()  # Model id: MacroComplex of each finished model
+        self.building = None  # MacroComplex being built, previewed while chains are added
+        self.preview_pending = False
+        self.preview_time = 0.0
         self.createWidgets()
+        self.reset_counters()
+        self.poll()
 
 
 if not os.path.exists('tmp'):
@@ -290,6 +417,7 @@ max_number_chains = IntVar()
 verbose = BooleanVar()
 stech_string = StringVar()
 dirty = BooleanVar()
+score = BooleanVar()
 directory.set('None')
 app = MB(master=root, padx=10, pady=10)
 root.mainloop()
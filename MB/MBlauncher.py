@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 # coding=utf-8
-from MB.MacroB import build_macrocomplex
+from MB.MacroB import build_macrocomplex, INTERFACE_RMSD
+from MB.BuildSettings import BuildSettings
+from MB.Frontier import FRONTIER_ORDERS
 from argparse import ArgumentParser
 
 parser = ArgumentParser(description='MacrocomplexBuilder is a python program designed to generate macrocomplex structures from simple pair inetractions pdb files.')
@@ -40,7 +42,8 @@ parser.add_argument('-d',
                     dest='dirty',
                     action="store_true",
                     default=False,
-                    help="Generates an output file for each added chain to track how the program builds the complex")
+                    help="Logs each added chain to a trajectory file (OUTPUT<model>_trajectory.jsonl) to track how the "
+                         "program builds the complex. Any step can be saved as a cif file with MBreplay.py")
 
 parser.add_argument('-v',
                     '--verbose',
@@ -54,7 +57,7 @@ stech.add_argument('-t',
                     action="store",
                     type=str,
                     default=False,
-                    help="Stechiometry given as a template pdb file")
+                    help="Stechiometry given as a template pdb file, models are also ranked by their RMSD to it")
 
 stech.add_argument('-s',
                     dest='stech_string',
@@ -63,6 +66,128 @@ stech.add_argument('-s',
                     default=False,
                     help="Stechiometry given as a string: A:6,B:11,C:2 ...")
 
-options = parser.parse_args()
-build_macrocomplex(options.directory, options.output, options.max_chains, options.num_models, dirty=options.dirty,
-                       verbose=options.verbose, template=options.template, stech_string=options.stech_string)
+parser.add_argument('-j',
+                    '--jobs',
+                    dest='jobs',
+                    action="store",
+                    type=int,
+                    default=1,
+                    help="Number of processes used to read the input files, compute their interactions, build the "
+                         "models and save them")
+
+parser.add_argument('-z',
+                    '--gzip',
+                    dest='compress',
+                    action="store_true",
+                    default=False,
+                    help="Saves the models as gzipped mmCIF files (.cif.gz)")
+
+parser.add_argument('--seed',
+                    dest='seed',
+                    action="store",
+                    type=int,
+                    default=None,
+                    help="Seed of the first model, model i uses seed + i - 1. The same seed reproduces the same "
+                         "model")
+
+parser.add_argument('--order',
+                    dest='order',
+                    action="store",
+                    choices=FRONTIER_ORDERS,
+                    default="fifo",
+                    help="Order in which the placed chains try their interactions: fifo (breadth first), most "
+                         "(chains with more interactions first) or random")
+
+parser.add_argument('--symmetry',
+                    dest='symmetry',
+                    action="store_true",
+                    default=False,
+                    help="Detects the symmetry operators (cyclic, dihedral, icosahedral, helical...) of the model "
+                         "while it is built, and places the copies they make directly. Copies don't try their own "
+                         "interactions, so helical assemblies capped by -c come out longer and less connected than "
+                         "without it")
+
+parser.add_argument('--interface-rmsd',
+                    dest='interface_rmsd',
+                    action="store",
+                    type=float,
+                    default=INTERFACE_RMSD,
+                    help="Interactions between the same chains whose relative positions are closer than this RMSD "
+                         "(in Angstroms) are collapsed into one, 0 keeps them all")
+
+parser.add_argument('--scores',
+                    dest='score',
+                    action="store_true",
+                    default=False,
+                    help="Scores the models in memory before saving them, and prints and saves the ranked table as "
+                         "OUTPUT_scores.tsv")
+
+parser.add_argument('--top',
+                    dest='top',
+                    action="store",
+                    type=int,
+                    default=None,
+                    help="Only saves the TOP best ranked models (implies --scores)")
+
+parser.add_argument('--time-budget',
+                    dest='time_budget',
+                    action="store",
+                    type=float,
+                    default=None,
+                    help="Maximum time (in seconds) to build each model. When it runs out, the model built until then "
+                         "is saved")
+
+parser.add_argument('--max-failures',
+                    dest='max_failures',
+                    action="store",
+                    type=int,
+                    default=None,
+                    help="Stops a model when this number of candidate chains in a row were rejected (clashes, "
+                         "duplicates or stoichiometry), keeping the model built until then")
+
+parser.add_argument('--checkpoint',
+                    dest='checkpoint',
+                    action="store_true",
+                    default=False,
+                    help="Saves the state of the models every 30 seconds while they are built (OUTPUT<model>_"
+                         "checkpoint.pkl), so an interrupted build can be resumed. They are deleted when it ends")
+
+parser.add_argument('--resume',
+                    dest='resume',
+                    action="store_true",
+                    default=False,
+                    help="Resumes the interrupted build of OUTPUT from its checkpoints, with the same seed and "
+                         "settings. It gives the same models as an uninterrupted build")
+
+parser.add_argument('--no-cache',
+                    dest='use_cache',
+                    action="store_false",
+                    default=True,
+                    help="Don't use the cache of preprocessed input files (stored in ~/.cache/MacroBuilder or in "
+                         "the MB_CACHE_DIR directory)")
+
+parser.add_argument('--stats',
+                    dest='stats_file',
+                    action="store",
+                    type=str,
+                    default=None,
+                    help="Saves as JSON the time of each stage and model and the counters of the modeling loop "
+                         "(superpositions, clash and stoichiometry rejections, neighbour queries, atoms copied)")
+
+parser.add_argument('--profile',
+                    dest='profile_file',
+                    action="store",
+                    type=str,
+                    default=None,
+                    help="Runs the modeling loop under cProfile and dumps its output to this file (only the main "
+                         "process is profiled)")
+
+if __name__ == "__main__":  # Needed by the worker processes, that import this module
+    options = parser.parse_args()
+    settings = BuildSettings(options.output, options.num_models, options.max_chains, template=options.template,
+                             stech_string=options.stech_string, dirty=options.dirty, verbose=options.verbose,
+                             jobs=options.jobs, seed=options.seed, compress=options.compress, order=options.order,
+                             symmetry=options.symmetry, score=options.score, top=options.top,
+                             checkpoint=options.checkpoint, resume=options.resume, time_budget=options.time_budget,
+                             max_failures=options.max_failures, profile_file=options.profile_file)
+    build_macrocomplex(options.directory, settings, options.use_cache, options.interface_rmsd, options.stats_file)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# coding=utf-8
+from MB.MacroB import read_pdbs, unify_ids, IDENTITY_THRESHOLD
+from MB.CustomPDB import CONTACT_DISTANCE
+from MB.PDBCache import PDBCache
+from MB.Trajectory import read_trajectory, get_trajectory_directory, replay_trajectory
+from argparse import ArgumentParser
+import sys
+
+parser = ArgumentParser(description='Saves any step of a MacrocomplexBuilder trajectory (generated with the dirty '
+                                    'option) as a cif file.')
+
+parser.add_argument("trajectory",
+                    action="store",
+                    type=str,
+                    help="Trajectory file (OUTPUT<model>_trajectory.jsonl)")
+
+parser.add_argument("-i",
+                    dest="directory",
+                    action="store",
+                    type=str,
+                    default=None,
+                    help="Input directory of the pair interaction pdbs, by default the one used to build the model")
+
+parser.add_argument("-s",
+                    dest="step",
+                    action="store",
+                    type=int,
+                    default=None,
+                    help="Step (number of chains) to save, by default the last one")
+
+parser.add_argument("-o",
+                    dest="output",
+                    action="store",
+                    type=str,
+                    default=None,
+                    help="Name of the output file, no extension is needed. By default the trajectory name and the step")
+
+parser.add_argument('-z',
+                    '--gzip',
+                    dest='compress',
+                    action="store_true",
+                    default=False,
+                    help="Saves the model as a gzipped mmCIF file (.cif.gz)")
+
+if __name__ == "__main__":
+    options = parser.parse_args()
+    header, steps = read_trajectory(options.trajectory)
+    directory = options.directory or get_trajectory_directory(steps)
+    if not directory:
+        sys.stderr.write("The trajectory doesn't tell its input directory, please give it with -i.")
+        sys.exit(1)
+    if not directory.endswith("/"):
+        directory += "/"
+    cache = PDBCache(thresholds=(IDENTITY_THRESHOLD, CONTACT_DISTANCE))
+    pdbmodels = read_pdbs(directory, cache=cache)
+    unify_ids(pdbmodels, cache=cache)
+    try:
+        macrocomplex = replay_trajectory(steps, pdbmodels, options.step, header.get("model", "Model"))
+    except KeyError:
+        sys.stderr.write("The input files of %s don't match the trajectory." % directory)
+        sys.exit(1)
+    output = options.output
+    if output is None:
+        output = options.trajectory.replace("_trajectory.jsonl", "") + "_step_" + str(len(macrocomplex))
+    macrocomplex.save_to_mmCIF(output, options.compress)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# coding=utf-8
+from MB.BuildService import BuildService, make_server, SERVICE_RESULTS
+from MB.BuildClient import SERVICE_PORT
+from argparse import ArgumentParser
+import os
+
+parser = ArgumentParser(description='Runs MacrocomplexBuilder as a local service: input directories are loaded once '
+                                    'into named sessions and build jobs are sent to them through an HTTP API (see '
+                                    'MB/BuildClient.py).')
+
+parser.add_argument('--host',
+                    dest='host',
+                    action="store",
+                    type=str,
+                    default="127.0.0.1",
+                    help="Address to listen on, only this machine by default")
+
+parser.add_argument('-p',
+                    '--port',
+                    dest='port',
+                    action="store",
+                    type=int,
+                    default=SERVICE_PORT,
+                    help="TCP port to listen on")
+
+parser.add_argument('--socket',
+                    dest='socket_path',
+                    action="store",
+                    type=str,
+                    default=None,
+                    help="Listens on this Unix socket instead of a TCP port")
+
+parser.add_argument('-w',
+                    '--workers',
+                    dest='workers',
+                    action="store",
+                    type=int,
+                    default=1,
+                    help="Number of jobs run at the same time, the others wait in the queue")
+
+parser.add_argument('-r',
+                    '--results',
+                    dest='results_dir',
+                    action="store",
+                    type=str,
+                    default=SERVICE_RESULTS,
+                    help="Directory where the models of each job are saved (in a subdirectory named by the job id)")
+
+parser.add_argument('-v',
+                    '--verbose',
+                    dest='verbose',
+                    action="store_true",
+                    default=False,
+                    help="Shows what the builds are doing and logs the requests")
+
+parser.add_argument('--no-cache',
+                    dest='use_cache',
+                    action="store_false",
+                    default=True,
+                    help="Don't use the cache of preprocessed input files when sessions are loaded")
+
+if __name__ == "__main__":  # Needed by the worker processes, that import this module
+    options = parser.parse_args()
+    service = BuildService(options.results_dir, options.workers, options.verbose, options.use_cache)
+    server = make_server(service, options.host, options.port, options.socket_path)
+    print("MacrocomplexBuilder service listening on " +
+          (options.socket_path or "http://%s:%s" % (options.host, options.port)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Stopping the service...")
+    finally:
+        server.server_close()
+        service.shutdown()
+        if options.socket_path and os.path.exists(options.socket_path):
+            os.remove(options.socket_path)
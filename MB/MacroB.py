@@ -1,33 +1,119 @@
 #!/usr/bin/env python
 # coding=utf-8
 from Bio.PDB.PDBParser import PDBParser
+from Bio.PDB.Model import Model
 from os import listdir
-import Bio.PDB.NeighborSearch
-from Bio.pairwise2 import align
+from multiprocessing import Pool
+from collections import Counter
+from functools import lru_cache
+import math
+import numpy as np
 import random
 import sys
-from MB.CustomPDB import CustomModel, CustomChain
+from MB.CustomPDB import CustomModel, CustomChain, ChainPlacement, MacroComplex, compact_chain, expand_chain, CONTACT_DISTANCE, CLASH_DISTANCE, POSE_DISTANCE, POSE_COSINE
+from MB.PDBCache import PDBCache
+from MB.Trajectory import TrajectoryWriter
+from MB.BuildStats import BuildStats, timed_stage
+from MB.InteractionGraph import InteractionGraph
+from MB.Frontier import Frontier
+from MB.Symmetry import SymmetryDetector, apply_operators
+from MB.Checkpoint import CheckpointWriter, get_model_state, restore_model_state, read_checkpoint, \
+    get_model_checkpoint_path, save_build_checkpoint, read_build_checkpoint, remove_checkpoints
+from MB.SpatialGrid import close_pairs, PoseIndex
+import cProfile
+import json
 import os
+import time
 
+IDENTITY_THRESHOLD = 0.95  # Minimum identity between two sequences to consider them the same chain
+KMER_SIZE = 3  # Size of the k-mers used to discard sequences that can't be homologs
+CLASH_RATIO = 0.03  # Fraction of clashing backbone atoms from which a chain is not added to the model
+CLASH_CHUNK = 128  # Number of atoms of each neighbour query when looking for clashes
+INTERFACE_RMSD = 2.0  # Maximum RMSD (in Angstroms) between two interfaces of the same chains to consider them equal
+INTERFACE_DISTANCE = 8.0  # Maximum distance (in Angstroms) between backbone atoms of two chains in contact
+SCORE_COLUMNS = ["model", "chains", "clash_score", "interfaces", "stoichiometry_deviation", "template_rmsd",
+                 "template_chains"]
 
-def read_pdbs(directory, verbose=False):
-    """Reads the input directory and generates pdb models"""
+
+def parse_pair_file(path):
+    """Parses a single pair interaction pdb file and returns a compact record with its chains, their sequences and the
+    interacting residues between them. It is the work unit of the parallel reading, so it only returns plain data."""
+    parser = PDBParser(PERMISSIVE=1, QUIET=True)
+    try:
+        chains = [CustomChain(chain) for chain in parser.get_structure("Model_pair", path)[0]]
+    except Exception:
+        return None
+    record = {"file": os.path.basename(path),
+              "chains": [compact_chain(chain) for chain in chains],
+              "sequences": [chain.get_sequence() for chain in chains],
+              "interface": None}
+    if len(chains) == 2:
+        record["interface"] = chains[0].get_interactions(chains[1])
+    return record
+
+
+def model_from_record(record):
+    """Rebuilds a pdb model from a parse_pair_file record. Sequences and interacting residues are kept in the xtra
+    attribute of the chains and the model, so they don't have to be computed again"""
+    model = Model(0)
+    for chain_record, sequence in zip(record["chains"], record["sequences"]):
+        chain = expand_chain(chain_record)
+        chain.xtra["sequence"] = sequence
+        model.add(chain)
+    model.xtra["interface"] = record["interface"]
+    model.xtra["file"] = record["file"]
+    return model
+
+
+def read_pdbs(directory, verbose=False, jobs=1, cache=None):
+    """Reads the input directory and generates pdb models. If jobs is bigger than 1, the files are parsed, and their
+    interactions computed, by a pool of worker processes. If a PDBCache is given, already seen files are loaded from
+    it and the new ones are stored"""
     if verbose:
         print("Reading pdb input files from %s" % directory)
-    parser = PDBParser(PERMISSIVE=1, QUIET=True)
     if os.path.isdir(directory) and directory.endswith("/"):
-        try:
-            pdbmodels = [parser.get_structure("Model_pair", directory + f)[0] for
-                    f in listdir(directory) if f.endswith(".pdb")] #  Generates pdb objects for files that end with .pdb
-        except:
-            sys.stderr.write("PDB files couldn't be opened. Please, revise that their format is correct.")
-            sys.exit(1)
+        files = sorted(f for f in listdir(directory) if f.endswith(".pdb"))  # Sorted to always get the same order
+        if jobs > 1 or cache:
+            records = [None] * len(files)
+            keys = [None] * len(files)
+            if cache:
+                keys = [cache.file_key(directory + f) for f in files]
+                records = [cache.get(key) for key in keys]
+                if verbose:
+                    print("%s of %s files found in cache" % (len(files) - records.count(None), len(files)))
+            missing = [i for i in range(len(files)) if records[i] is None]
+            if jobs > 1 and len(missing) > 1:
+                with Pool(jobs) as pool:
+                    new_records = pool.map(parse_pair_file, [directory + files[i] for i in missing])
+            else:
+                new_records = [parse_pair_file(directory + files[i]) for i in missing]
+            if None in new_records:
+                sys.stderr.write("PDB files couldn't be opened. Please, revise that their format is correct.")
+                sys.exit(1)
+            for i, record in zip(missing, new_records):
+                records[i] = record
+                if cache:
+                    cache.put(keys[i], record, evict=False)
+            if cache and missing:
+                cache.evict()  # Once for all the new entries
+            pdbmodels = [model_from_record(record) for record in records]  # Only the parent builds the models
+            for model, key in zip(pdbmodels, keys):
+                model.xtra["cache_key"] = key
+        else:
+            parser = PDBParser(PERMISSIVE=1, QUIET=True)
+            try:
+                pdbmodels = [parser.get_structure("Model_pair", directory + f)[0] for f in files]
+            except:
+                sys.stderr.write("PDB files couldn't be opened. Please, revise that their format is correct.")
+                sys.exit(1)
     else:
         sys.stderr.write("Directory %s doesn't exists, please select a valid directory." % directory)
         sys.exit(1)
     if not bool(pdbmodels):  # If no pdb instance is generated
         sys.stderr.write("No pdb files where read. Please make sure the given directory contains pdb files. ")
         sys.exit(1)
+    for model, f in zip(pdbmodels, files):
+        model.xtra["path"] = directory + f  # Source of the chains, used by the assembly trajectories
     for model in pdbmodels:
         if len(model.child_list) != 2:
             sys.stderr.write("A pdb input file doesn't contains two chains. Please, all input pdbs must only contain "
@@ -49,29 +135,182 @@ def get_new_id(iterator):
     exit(1)
 
 
+@lru_cache(maxsize=1024)
+def get_kmer_counts(seq, k=KMER_SIZE):
+    """Returns a Counter with the number of times each k-mer appears in the sequence"""
+    return Counter(seq[i:i + k] for i in range(len(seq) - k + 1))
+
+
+def get_lcs_length(seq_1, seq_2):
+    """Returns the length of the longest common subsequence of two sequences. It uses the bit-parallel algorithm of
+    Allison and Dix, with python integers as bit vectors, so each character of seq_2 costs a few integer operations"""
+    masks = {}  # For each character, the bits of the positions where it appears in seq_1
+    for i, char in enumerate(seq_1):
+        masks[char] = masks.get(char, 0) | (1 << i)
+    full = (1 << len(seq_1)) - 1
+    v = full
+    for char in seq_2:
+        u = v & masks.get(char, 0)
+        v = ((v + u) | (v - u)) & full
+    return len(seq_1) - bin(v).count("1")  # Each zero bit is a matched position
+
+
+@lru_cache(maxsize=65536)
+def sequence_identity(seq_1, seq_2, threshold=0.0):
+    """Returns the identity of the best global alignment of two sequences without gap penalties (like
+    pairwise2.align.globalxx), this is, identities / alignment length, where identities is the length of the longest
+    common subsequence and the alignment length is len(seq_1) + len(seq_2) - identities. If the identity can't reach
+    the threshold, it may return 0 without aligning the sequences. Results are memoized, as the same pairs of
+    sequences are compared for every chain"""
+    if seq_1 == seq_2:
+        return 1.0
+    len_1, len_2 = len(seq_1), len(seq_2)
+    min_len, max_len = min(len_1, len_2), max(len_1, len_2)
+    if not min_len or min_len < threshold * max_len:  # Identity is at most min_len / max_len
+        return 0.0
+    min_lcs = threshold * (len_1 + len_2) / (1 + threshold)  # Minimum common subsequence to reach the threshold
+    max_edits = len_1 + len_2 - 2 * math.ceil(min_lcs)  # So, maximum number of insertions and deletions
+    # q-gram lemma: two sequences at edit distance e share at least max_len - k + 1 - k * e k-mers
+    min_shared_kmers = max_len - KMER_SIZE + 1 - KMER_SIZE * max_edits
+    if min_shared_kmers > 0:
+        shared_kmers = sum((get_kmer_counts(seq_1) & get_kmer_counts(seq_2)).values())
+        if shared_kmers < min_shared_kmers:
+            return 0.0
+    lcs = get_lcs_length(seq_1, seq_2)
+    return lcs / (len_1 + len_2 - lcs)
+
+
 def has_homolgs(target_seq, known_seqs):
     """Checks if a given sequence is an homolog of any of the known sequences and returns it"""
     for k_seq in known_seqs:
-        alignment = align.globalxx(target_seq, k_seq)[0] # Generates and selects the alignment with the best score
-        aln_seq_1 = alignment[0]  # Get the first sequence of the alignment (with - as gaps )
-        aln_seq_2 = alignment[1]  # Get the second one
-        al_length = len(alignment[0])
-        ident = sum(base1 == base2 for base1, base2 in zip(aln_seq_1, aln_seq_2))  # Calculate number of identities
-        if ident/al_length >= 0.95:  # If 95% of identity, return known sequence
-            return k_seq
+        if sequence_identity(target_seq, k_seq, IDENTITY_THRESHOLD) >= IDENTITY_THRESHOLD:  # If 95% of identity,
+            return k_seq  # return known sequence
+
+
+@lru_cache(maxsize=1024)
+def get_residue_alignment(seq_1, seq_2):
+    """Returns a tuple of (position in seq_1, position in seq_2) pairs of the residues aligned by the longest common
+    subsequence of two sequences"""
+    if seq_1 == seq_2:
+        return tuple((i, i) for i in range(len(seq_1)))
+    len_1, len_2 = len(seq_1), len(seq_2)
+    lengths = [[0] * (len_2 + 1) for _ in range(len_1 + 1)]  # Dynamic programming table of LCS lengths
+    for i in range(len_1 - 1, -1, -1):
+        row, next_row = lengths[i], lengths[i + 1]
+        for j in range(len_2 - 1, -1, -1):
+            if seq_1[i] == seq_2[j]:
+                row[j] = next_row[j + 1] + 1
+            else:
+                row[j] = max(next_row[j], row[j + 1])
+    pairs = []
+    i = j = 0
+    while i < len_1 and j < len_2:  # Traceback from the start of both sequences
+        if seq_1[i] == seq_2[j]:
+            pairs.append((i, j))
+            i += 1
+            j += 1
+        elif lengths[i + 1][j] >= lengths[i][j + 1]:
+            i += 1
+        else:
+            j += 1
+    return tuple(pairs)
+
+
+def get_residue_atom_indices(chain):
+    """Returns a list with a dictionary {atom name: index in the chain's coordinate array} for each residue of the
+    chain's sequence"""
+    residues = []
+    index = 0
+    for residue in chain:
+        names = dict()
+        for atom in residue:
+            names[atom.get_id()] = index
+            index += 1
+        if residue.id[0] == " ":  # Same residues that get_sequence uses
+            residues.append(names)
+    return residues
+
+
+def build_correspondence_index(pdbmodels):
+    """Builds the atom correspondence index of every chain. For each chain id, the first chain is the reference, and
+    the residues of all the chains with that id are aligned to it. Each chain gets in xtra["correspondence"] an array
+    with, for each (residue, atom name) of the reference, the index of the same atom in the chain's coordinate array
+    (or -1 if it's missing). Any two chains with the same id can then be superimposed just gathering coordinates"""
+    references = dict()  # Chain id: (reference sequence, {(residue position, atom name): key index})
+    for model in pdbmodels:
+        for chain in model:
+            residues = get_residue_atom_indices(chain)
+            chain_seq = chain.get_sequence()
+            if chain.id not in references:
+                keys = [(position, name) for position, names in enumerate(residues) for name in names]
+                references[chain.id] = (chain_seq, {key: i for i, key in enumerate(keys)})
+            reference_seq, key_index = references[chain.id]
+            correspondence = np.full(len(key_index), -1, dtype=np.int64)
+            for reference_position, position in get_residue_alignment(reference_seq, chain_seq):
+                for name, atom_index in residues[position].items():
+                    key = key_index.get((reference_position, name))
+                    if key is not None:
+                        correspondence[key] = atom_index
+            chain.xtra["correspondence"] = correspondence
+
+
+def get_superposition(fixed_coords, moving_coords):
+    """Returns the rotation matrix and the translation vector that minimize the RMSD between two paired arrays of
+    coordinates (Kabsch algorithm). Like biopython's Superimposer, the moved coordinates are moving @ rot + tran"""
+    fixed_center = fixed_coords.mean(axis=0)
+    moving_center = moving_coords.mean(axis=0)
+    correlation = np.dot((moving_coords - moving_center).T, fixed_coords - fixed_center)
+    u, d, vt = np.linalg.svd(correlation)
+    rot = np.dot(u, vt)
+    if np.linalg.det(rot) < 0:  # Avoids reflections
+        vt[2] = -vt[2]
+        rot = np.dot(u, vt)
+    tran = fixed_center - np.dot(moving_center, rot)
+    return rot, tran
 
 
-def unify_ids(pdbmodels, verbose=False):
-    """Unifies chain identifiers and updates the pdb models to CustomModel class"""
+def get_superpositions(pairs):
+    """Like get_superposition for a list of (fixed_coords, moving_coords) pairs, with a single stacked SVD of all
+    their correlation matrices. Returns a list of (rot, tran)"""
+    fixed_centers = np.array([fixed_coords.mean(axis=0) for fixed_coords, moving_coords in pairs])
+    moving_centers = np.array([moving_coords.mean(axis=0) for fixed_coords, moving_coords in pairs])
+    correlations = np.array([np.dot((moving_coords - moving_center).T, fixed_coords - fixed_center)
+                             for (fixed_coords, moving_coords), fixed_center, moving_center
+                             in zip(pairs, fixed_centers, moving_centers)])
+    u, d, vt = np.linalg.svd(correlations)
+    rots = np.matmul(u, vt)
+    reflections = np.linalg.det(rots) < 0  # Avoids reflections
+    vt[reflections, 2] = -vt[reflections, 2]
+    rots[reflections] = np.matmul(u[reflections], vt[reflections])
+    trans = fixed_centers - np.einsum("ki,kij->kj", moving_centers, rots)
+    return list(zip(rots, trans))
+
+
+def unify_ids(pdbmodels, verbose=False, cache=None):
+    """Unifies chain identifiers and updates the pdb models to CustomModel class. If a PDBCache is given and the same
+    input files were already unified, the ids are taken from it instead of checking the homologies again"""
     seq_dict = dict()  # Dictionary where sequences are keys and ids are values
     if verbose:
         print("Unifying Ids")
+    cache_key = None
+    cached_ids = None
+    if cache and all(pdb.xtra.get("cache_key") for pdb in pdbmodels):
+        cache_key = cache.group_key([pdb.xtra["cache_key"] for pdb in pdbmodels], "unify_ids")
+        cached = cache.get(cache_key)
+        if cached:
+            seq_dict, cached_ids = cached  # cached_ids has the ids of the chains of each model
     for i in range(len(pdbmodels)):
         pdb = pdbmodels[i]
         model = CustomModel(str(i))  # Transforms model to CustomModel instance
-        for chain in pdb:
+        model.xtra = pdb.xtra  # Keeps the information precomputed while reading
+        for j, chain in enumerate(pdb):
             chain = CustomChain(chain)  # Transforms chain to CustomChain instance
             chain.parent = None  # Removes previous parent from chain
+            chain.xtra["number"] = j  # Position of the chain in its input file
+            if cached_ids:
+                chain.id = cached_ids[i][j]
+                model.add(chain)
+                continue
             chain_seq = chain.get_sequence()
             if chain_seq not in seq_dict:
                 if not seq_dict:  # If the sequence dictionary is empty
@@ -93,6 +332,9 @@ def unify_ids(pdbmodels, verbose=False):
                 chain.id = seq_dict[chain_seq]  # If chain is already in seq_dict, update chain object id
             model.add(chain)
         pdbmodels[i] = model  # Update pdbmodels list with the updated model
+    if cache_key and not cached_ids:
+        cache.put(cache_key, (seq_dict, [[chain.id for chain in model] for model in pdbmodels]))
+    build_correspondence_index(pdbmodels)  # Pairs the atoms of the chains with the same id for the superpositions
     if verbose:
         print("Ids unified")
     return seq_dict
@@ -122,10 +364,13 @@ def get_interaction_dict(clean_pdbs, verbose=False):
         print("Generating interaction dictionary...")
     for pdb in clean_pdbs:
         chain1, chain2 = list(pdb.get_chains())
-        inter1_2, inter2_1 = chain1.get_interactions(chain2)  # Generates interaction tuples,
-        # from chain 1 to 2 and from 2 to 1. For instance:
-        # inter1_2 = (2,40,120)
-        # inter2_1=(34, 20)
+        if pdb.xtra.get("interface") is not None:  # Already computed by the reading workers
+            inter1_2, inter2_1 = pdb.xtra["interface"]
+        else:
+            inter1_2, inter2_1 = chain1.get_interactions(chain2)  # Generates interaction tuples,
+            # from chain 1 to 2 and from 2 to 1. For instance:
+            # inter1_2 = (2,40,120)
+            # inter2_1=(34, 20)
         if inter1_2 != ():  # If tuple is not empty (there is an interaction)
             interaction_dict.setdefault(chain1.id, dict())[inter1_2] = (chain1, chain2, inter2_1) # Update dictionary
         if inter2_1 != ():  # Same for the other interaction
@@ -135,59 +380,305 @@ def get_interaction_dict(clean_pdbs, verbose=False):
     return interaction_dict
 
 
-def update_interactions_dict(interaction_dict, verbose=False):
-    """Updates the interactions attribute of each chain inside the dictionary"""
+def get_interface_rmsd(interaction_1, interaction_2):
+    """Returns the RMSD between the chains to add of two interactions once their fixed chains are superimposed, this
+    is, how different the relative positions of the two pairs of chains are"""
+    fix_1, to_move_1 = interaction_1[:2]
+    fix_2, to_move_2 = interaction_2[:2]
+    fix_index_1, fix_index_2 = fix_1.get_common_atom_indices(fix_2)
+    rot, tran = get_superposition(fix_2.get_coord_array()[fix_index_2], fix_1.get_coord_array()[fix_index_1])
+    move_index_1, move_index_2 = to_move_1.get_common_atom_indices(to_move_2)
+    moved = np.dot(to_move_1.get_coord_array()[move_index_1], rot) + tran
+    return float(np.sqrt(((moved - to_move_2.get_coord_array()[move_index_2]) ** 2).sum(axis=1).mean()))
+
+
+def remove_redundant_interactions(interaction_dict, tolerance=INTERFACE_RMSD, verbose=False):
+    """Removes from the interaction dictionary the interactions that are equivalent to a previous one: between
+    chains with the same ids and with an RMSD of the relative position of the chains (see get_interface_rmsd) under
+    the tolerance. Each of them would place the same chain as the kept one, so they only cost superpositions and
+    clash checks. Returns the number of interactions removed"""
     if verbose:
-        print("Updating interaction dictionary...")
-    for chain in interaction_dict:
-        for interaction_tple in interaction_dict[chain]:
-            chain1, chain2, ref_inter = interaction_dict[chain][interaction_tple] # De-packs the interaction tuple value
-            # Generates a list with all interactions of that key minus the current one
-            chain1_filtered_interactions_lst = [x for x in interaction_dict[chain1.id].keys() if x != interaction_tple]
-            # Updates chain_interaction attribute with the list of interaction tuples
-            chain1.add_interaction_lst(chain1_filtered_interactions_lst)
-            # Generates a list with all interactions minus the one from chain2 to chain1
-            chain2_filtered_interactions_lst = [x for x in interaction_dict[chain2.id].keys() if x != ref_inter]
-            chain2.add_interaction_lst(chain2_filtered_interactions_lst)
-            parent = chain1.get_parent()
-            parent.child_list = [chain1, chain2] # Updates the model chains with these new updated chains
-            interaction_dict[chain][interaction_tple] = chain1, chain2 # Updates the dictionary value
-            # (now without the interaction from chain 2 to 1)
+        print("Removing redundant interactions...")
+    removed = 0
+    for chain_id in interaction_dict:
+        representatives = dict()  # Id of the chain to add: kept interactions
+        for key, interaction in list(interaction_dict[chain_id].items()):
+            kept = representatives.setdefault(interaction[1].id, [])
+            if any(get_interface_rmsd(interaction, other) <= tolerance for other in kept):
+                del interaction_dict[chain_id][key]
+                removed += 1
+            else:
+                kept.append(interaction)
     if verbose:
-        print("Interaction dictionary updated")
+        print("%s redundant interactions removed" % removed)
+    return removed
 
 
-def has_clashes(move_atoms, model):
-    """Compares the atoms backbone atoms of the moving chain with the backbone atoms of the model"""
-    backbone = {"CA", "C1\'"}
-    chain_atoms = [atom for atom in move_atoms if atom.id in backbone]  # Gets only the backbone atoms
-    model_atoms = [atom for atom in model.get_atoms() if atom.id in backbone]
-    ns = Bio.PDB.NeighborSearch(model_atoms)  # Generates a neigbour search tree to speed up distance calculations
-    clashes = 0
-    for atom in chain_atoms:
-        clashes += bool(ns.search(atom.coord, 2))  # If this atom shows clashes, add 1 to the clashes counter
-    if clashes/len(chain_atoms) >= 0.03:  # If more than 3% of atoms show clashes return yes
-        return True
-    else:  # Otherwise return no
+def get_interaction_graph(interaction_dict, verbose=False):
+    """Builds the InteractionGraph of the interaction dictionary, which also sets the interactions attribute of each
+    chain to the edges it can try"""
+    if verbose:
+        print("Building interaction graph...")
+    interaction_graph = InteractionGraph(interaction_dict)
+    if verbose:
+        print("Interaction graph built: %s interactions" % len(interaction_graph))
+    return interaction_graph
+
+
+def has_clashes(move_coords, model, sphere=None, stats=None):
+    """Compares the backbone coordinates of the moving chain with the backbone atoms of the model. First, only the
+    model's chains whose bounding spheres are close to the moving chain's sphere are kept, and only the moving atoms
+    inside their spheres can clash. Those atoms are looked up in the model's spatial hash by chunks, stopping as soon
+    as the clash ratio is reached or can't be reached anymore"""
+    num_atoms = len(move_coords)
+    if not num_atoms:
+        return False
+    if sphere is None:
+        center = move_coords.mean(axis=0)
+        sphere = center, float(np.sqrt(((move_coords - center) ** 2).sum(axis=1).max()))
+    center, radius = sphere
+    margin = CLASH_DISTANCE + 1e-6  # Rounding errors must never hide a clash
+    centers, radii = model.get_near_spheres(center, radius + margin)
+    if not len(radii):  # No chain is close enough, the atoms don't need to be checked
         return False
+    distances = ((move_coords[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2)
+    candidates = move_coords[(distances <= (radii + margin) ** 2).any(axis=1)]  # The only atoms that can clash
+    clashes = 0
+    for start in range(0, len(candidates), CLASH_CHUNK):
+        if (clashes + len(candidates) - start) / num_atoms < CLASH_RATIO:  # Even if all the rest clashed
+            return False
+        chunk = candidates[start:start + CLASH_CHUNK]
+        if stats:
+            stats.count("neighbour_queries")
+            stats.count("atoms_queried", len(chunk))
+        # The model keeps a spatial hash of its backbone, so only the moving chain's atoms have to be processed
+        clashes += int(model.get_backbone_index().has_neighbours(chunk, CLASH_DISTANCE).sum())
+        if clashes / num_atoms >= CLASH_RATIO:  # If more than 3% of atoms show clashes return yes
+            return True
+    return False
+
+
+def get_placement_transform(placement, fix, superpositions):
+    """Returns the rotation and translation that move the chains of an interaction (fix and the chain to add) so fix
+    is superimposed on the given placement. The superposition between two template chains is always the same, so it
+    is computed once, stored in the superpositions dictionary, and composed with the placement's transformation"""
+    key = (id(placement.template), id(fix))
+    if key not in superpositions:
+        template_index, fix_index = placement.template.get_common_atom_indices(fix)  # Get common atoms between
+        # the macrocomplex chain's template and the one in the interaction dictionary
+        superpositions[key] = get_superposition(placement.template.get_coord_array()[template_index],
+                                                fix.get_coord_array()[fix_index])
+    rot, tran = superpositions[key]
+    return np.dot(rot, placement.rot), np.dot(tran, placement.rot) + placement.tran
 
 
-def get_starting_model(interaction_dict, verbose=False):
-    """Returns as a starting model one of the CustomModel of the chain with more recorded interactions"""
+def get_atoms_in_spheres(coords, sizes, candidates, centers, radii):
+    """Returns the atoms of a batch of candidates (coords has the backbones of all of them, one after the other, with
+    the given sizes) inside some spheres, enlarged by CLASH_DISTANCE: the atoms of candidates[k] are compared with
+    sphere k. They are the only ones that can clash with what is inside the spheres. Returns the atoms and the sphere
+    of each one, grouped by sphere"""
+    margin = CLASH_DISTANCE + 1e-6  # Rounding errors must never hide a clash
+    counts = sizes[candidates]
+    atoms = np.repeat((np.cumsum(sizes) - sizes)[candidates], counts) + np.arange(counts.sum()) - \
+        np.repeat(np.cumsum(counts) - counts, counts)  # Atom of each (atom, sphere) pair
+    spheres = np.repeat(np.arange(len(candidates)), counts)
+    inside = ((coords[atoms] - centers[spheres]) ** 2).sum(axis=1) <= (radii[spheres] + margin) ** 2
+    return atoms[inside], spheres[inside]
+
+
+def get_batch_clashes(placements, macrocomplex, stats=None):
+    """Moves the backbones of a batch of candidate placements with one array operation and looks for their clashes
+    with the model. As in has_clashes, only the atoms inside the bounding sphere of a close placed chain can clash,
+    and they are looked up by chunks of CLASH_CHUNK atoms of each candidate, but the chunks of all the candidates
+    still undecided go in a single query of the model's spatial hash. Returns the check of each candidate, a
+    dictionary with its backbone coordinates, if it clashes, and two boolean arrays of its atoms: the ones close to
+    the model and the ones that could be but were not looked up (the candidate was decided before)"""
+    if not placements:
+        return []
+    backbones = [placement.template.get_backbone_coords() for placement in placements]
+    sizes = np.array([len(backbone) for backbone in backbones], dtype=np.int64)
+    owners = np.repeat(np.arange(len(placements)), sizes)  # Candidate of each atom
+    rots = np.array([placement.rot for placement in placements])
+    trans = np.array([placement.tran for placement in placements])
+    coords = np.einsum("ni,nij->nj", np.concatenate(backbones), rots[owners]) + trans[owners]
+    bounding_spheres = [placement.get_bounding_sphere() for placement in placements]
+    centers = np.array([center for center, radius in bounding_spheres])
+    radii = np.array([radius for center, radius in bounding_spheres])
+    model_centers, model_radii = macrocomplex.get_spheres()
+    margin = CLASH_DISTANCE + 1e-6  # Rounding errors must never hide a clash
+    distances = ((centers[:, None, :] - model_centers[None, :, :]) ** 2).sum(axis=2)
+    near_candidates, near_spheres = np.nonzero(distances <= (radii[:, None] + model_radii[None, :] + margin) ** 2)
+    query = np.zeros(len(coords), dtype=bool)
+    query[get_atoms_in_spheres(coords, sizes, near_candidates, model_centers[near_spheres],
+                               model_radii[near_spheres])[0]] = True
+    query_atoms = np.flatnonzero(query)  # The only atoms that can clash, sorted by candidate
+    query_counts = np.bincount(owners[query_atoms], minlength=len(placements))
+    ranks = np.arange(len(query_atoms)) - np.repeat(np.cumsum(query_counts) - query_counts, query_counts)
+    clashes = np.zeros(len(placements), dtype=np.int64)
+    undecided = np.ones(len(placements), dtype=bool)
+    num_atoms = np.maximum(sizes, 1)
+    near = np.zeros(len(coords), dtype=bool)  # Atoms found close to the model
+    start = 0
+    while undecided.any():
+        remaining = np.maximum(query_counts - start, 0)
+        undecided &= (clashes + remaining) / num_atoms >= CLASH_RATIO  # Not even if all the rest clashed
+        chunk = query_atoms[undecided[owners[query_atoms]] & (ranks >= start) & (ranks < start + CLASH_CHUNK)]
+        if not len(chunk):
+            break
+        if stats:
+            stats.count("neighbour_queries")
+            stats.count("atoms_queried", len(chunk))
+        found = macrocomplex.get_backbone_index().has_neighbours(coords[chunk], CLASH_DISTANCE)
+        near[chunk[found]] = True
+        query[chunk] = False  # Only the atoms never looked up are left
+        clashes += np.bincount(owners[chunk[found]], minlength=len(placements))
+        undecided &= clashes / num_atoms < CLASH_RATIO  # The clashing ones are decided
+        start += CLASH_CHUNK
+    if stats:
+        stats.count("batch_queries")
+        stats.count("atoms_copied", len(coords))
+    splits = np.cumsum(sizes)[:-1]
+    return [{"coords": move_coords, "clashes": move_clashes, "near": move_near, "unknown": move_unknown}
+            for move_coords, move_clashes, move_near, move_unknown in
+            zip(np.split(coords, splits), (clashes / num_atoms >= CLASH_RATIO).tolist(), np.split(near, splits),
+                np.split(query, splits))]
+
+
+def get_batch_contacts(placements, checks, stats=None):
+    """Finds at once the contacts (backbone atoms at CLASH_DISTANCE or less) between the candidates of a batch that
+    don't clash with the model, as they may be added in order and clash with the earlier ones. Only the atoms inside
+    the bounding sphere of another close candidate, and inside the bounding box of its atoms in the own sphere, are
+    compared (see close_pairs). Adds to the check of each candidate two arrays, with one item per contact with an
+    earlier candidate: the number of that candidate and the own atom"""
+    empty = np.zeros(0, dtype=np.int64)
+    numbers = np.array([number for number, check in enumerate(checks) if not check["clashes"]], dtype=np.int64)
+    for check in checks:
+        check["others"], check["atoms"] = empty, empty
+    if len(numbers) < 2:
+        return
+    bounding_spheres = [placements[number].get_bounding_sphere() for number in numbers.tolist()]
+    centers = np.array([center for center, radius in bounding_spheres])
+    radii = np.array([radius for center, radius in bounding_spheres])
+    margin = CLASH_DISTANCE + 1e-6  # Rounding errors must never hide a clash
+    distances = ((centers[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2)
+    close_1, close_2 = np.nonzero(np.triu(distances <= (radii[:, None] + radii[None, :] + margin) ** 2, 1))
+    if not len(close_1):  # No two candidates are close
+        return
+    coords = [checks[number]["coords"] for number in numbers.tolist()]
+    sizes = np.array([len(move_coords) for move_coords in coords], dtype=np.int64)
+    coords = np.concatenate(coords)
+    owners = np.repeat(np.arange(len(numbers)), sizes)  # Candidate of each atom
+    # Atoms of the later candidate of each close pair inside the earlier one's sphere, and the other way round
+    later_atoms, later_pairs = get_atoms_in_spheres(coords, sizes, close_2, centers[close_1], radii[close_1])
+    earlier_atoms, earlier_pairs = get_atoms_in_spheres(coords, sizes, close_1, centers[close_2], radii[close_2])
+    # Of those, only the ones inside the bounding box of the other side (enlarged by CLASH_DISTANCE) can be in contact
+    lows, highs = np.full((2, len(close_1), 3), np.inf), np.full((2, len(close_1), 3), -np.inf)
+    for side, (atoms, pairs) in enumerate([(later_atoms, later_pairs), (earlier_atoms, earlier_pairs)]):
+        if len(atoms):
+            starts = np.flatnonzero(np.diff(pairs, prepend=-1))  # The atoms are grouped by pair
+            lows[side][pairs[starts]] = np.minimum.reduceat(coords[atoms], starts)
+            highs[side][pairs[starts]] = np.maximum.reduceat(coords[atoms], starts)
+    in_box = np.zeros((2, len(coords)), dtype=bool)  # Atoms to compare on each side
+    for side, (atoms, pairs) in enumerate([(later_atoms, later_pairs), (earlier_atoms, earlier_pairs)]):
+        atom_coords = coords[atoms]
+        in_box[side, atoms[np.all((atom_coords >= lows[1 - side][pairs] - margin) &
+                                  (atom_coords <= highs[1 - side][pairs] + margin), axis=1)]] = True
+    later_atoms, earlier_atoms = np.flatnonzero(in_box[0]), np.flatnonzero(in_box[1])
+    if stats:
+        stats.count("contact_queries")
+        stats.count("atoms_compared", len(later_atoms) + len(earlier_atoms))
+    pairs_1, pairs_2 = close_pairs(coords[later_atoms], coords[earlier_atoms], CLASH_DISTANCE)
+    pairs_1, pairs_2 = later_atoms[pairs_1], earlier_atoms[pairs_2]
+    later = owners[pairs_1] > owners[pairs_2]  # Each contact is kept by the later candidate
+    order = np.argsort(owners[pairs_1[later]], kind="stable")
+    pairs_1, pairs_2 = pairs_1[later][order], pairs_2[later][order]
+    splits = np.cumsum(np.bincount(owners[pairs_1], minlength=len(numbers)))[:-1]
+    own_atoms = pairs_1 - (np.cumsum(sizes) - sizes)[owners[pairs_1]]
+    for number, others, move_atoms in zip(numbers.tolist(), np.split(numbers[owners[pairs_2]], splits),
+                                          np.split(own_atoms, splits)):
+        checks[number]["others"], checks[number]["atoms"] = others, move_atoms
+
+
+def evaluate_placements(placements, macrocomplex, stats=None):
+    """Checks a batch of candidate placements at once, before they are tried in order. The ones with the pose of a
+    chain of the model are duplicates, and the ones with the pose of an earlier candidate will be duplicates if it is
+    added (or checked alone if it isn't), so the rest are moved and checked for clashes with the model and between
+    them (see get_batch_clashes and get_batch_contacts). Returns the check of each placement, None if it was skipped"""
+    poses = PoseIndex(POSE_DISTANCE, POSE_COSINE)  # Poses of the batch
+    numbers = []
+    for number, placement in enumerate(placements):
+        center, axes = placement.get_bounding_sphere()[0], placement.get_pose_axes()
+        if macrocomplex.find_duplicate(placement) is None and poses.find(placement.id, center, axes) is None:
+            poses.add(placement.id, center, axes, placement)
+            numbers.append(number)
+    candidates = [placements[number] for number in numbers]
+    batch_checks = get_batch_clashes(candidates, macrocomplex, stats)
+    get_batch_contacts(candidates, batch_checks, stats)
+    checks = [None] * len(placements)
+    for number, check in zip(numbers, batch_checks):
+        check["others"] = np.array(numbers, dtype=np.int64)[check["others"]]  # Numbers in the whole batch
+        checks[number] = check
+    return checks
+
+
+def has_batch_clashes(move, check, placements, macrocomplex, batch_start, stats=None):
+    """Tells if a candidate of a batch (see evaluate_placements) clashes with the current model, knowing its atoms
+    close to the model as it was when the batch was evaluated (with batch_start chains) and to the other candidates.
+    Only the candidates skipped by the batch, or close to a chain added since then that isn't a candidate (a copy
+    skipped by the batch and added after being checked alone), or whose clashes can't be told without the atoms not
+    looked up, are checked again. The result is always the same has_clashes would give. Returns it and the candidate's backbone coordinates"""
+    if check is None:  # At the pose of an earlier candidate that was not added
+        move_coords = move.get_backbone_coords()
+        if stats:
+            stats.count("atoms_copied", len(move_coords))
+        return has_clashes(move_coords, macrocomplex, move.get_bounding_sphere(), stats), move_coords
+    move_coords = check["coords"]
+    if check["clashes"] or not len(move_coords):
+        return check["clashes"], move_coords
+    added = np.array([placement.parent is not None for placement in placements], dtype=bool)
+    if len(macrocomplex) - batch_start > added.sum():  # Chains not in the batch were added
+        center, radius = move.get_bounding_sphere()
+        centers, radii = macrocomplex.get_spheres()
+        others = np.setdiff1d(np.arange(batch_start, len(macrocomplex)),
+                              [placement.number for placement in placements if placement.parent is not None])
+        distances = ((centers[others] - center) ** 2).sum(axis=1)
+        if (distances <= (radii[others] + radius + CLASH_DISTANCE + 1e-6) ** 2).any():
+            return has_clashes(move_coords, macrocomplex, (center, radius), stats), move_coords
+    known = check["near"].copy()
+    known[check["atoms"][added[check["others"]]]] = True  # Close to an added candidate
+    num_atoms = len(move_coords)
+    clashes = int(known.sum())
+    if clashes / num_atoms >= CLASH_RATIO:
+        return True, move_coords
+    unknown = check["unknown"] & ~known
+    if (clashes + int(unknown.sum())) / num_atoms < CLASH_RATIO:  # Even if all the rest clashed
+        return False, move_coords
+    if stats:
+        stats.count("neighbour_queries")
+        stats.count("atoms_queried", int(unknown.sum()))
+    clashes += int(macrocomplex.get_backbone_index().has_neighbours(move_coords[unknown], CLASH_DISTANCE).sum())
+    return clashes / num_atoms >= CLASH_RATIO, move_coords
+
+
+def get_starting_model(interaction_graph, verbose=False):
+    """Returns as starting model the two template chains of an interaction of the chain with more recorded
+    interactions (the input chains themselves, they must not be modified)"""
     if verbose:
         print("Selecting best interaction from where to start modeling...")
-    max_len = 0
-    interaction_key = None
-    for key in interaction_dict:
-        length = len(interaction_dict[key])
-        if length > max_len:  # If a chain has more interactions
-            max_len = length  # Updates maximum interaction umber
-            interaction_key = key  # Updates maximum interaction chain key
-    inter_tple = next(iter(interaction_dict[interaction_key]))  # Gets an interaction tuple of the chain
-    # with more interactions
+    chains = interaction_graph.get_starting_chains()
     if verbose:
         print("First two chains added")
-    return interaction_dict[interaction_key][inter_tple][0].parent.copy()  # Returns the model of the interaction tuple
+    return chains
+
+
+def stoichiometry_met(model_stech, stech_dict):
+    """Checks if the model has all the chains asked by the stoichiometry (never if there is no stoichiometry)"""
+    if not stech_dict:
+        return False
+    for chain_id, number in stech_dict.items():
+        if model_stech.get(chain_id, 0) < number:
+            return False
+    return True
 
 
 def generate_model_profile(model):
@@ -199,95 +690,538 @@ def generate_model_profile(model):
     return profile
 
 
-def save_results(out_models, output):
-    """Saves the resulting models into cif files (at the current working directory"""
-    i = 1
+def get_residue_backbone_indices(chain):
+    """Returns an array with the index (in the chain's backbone coordinates) of the backbone atom of each residue of
+    the chain's sequence, -1 for the residues without it. It is kept in the chain's xtra"""
+    if "residue_backbone" not in chain.xtra:
+        chain.get_backbone_coords()  # Sets the indices of the backbone atoms
+        backbone = {atom_index: i for i, atom_index in enumerate(chain.xtra["backbone"].tolist())}
+        residues = [[backbone[index] for index in names.values() if index in backbone]
+                    for names in get_residue_atom_indices(chain)]
+        chain.xtra["residue_backbone"] = np.array([indices[0] if indices else -1 for indices in residues],
+                                                  dtype=np.int64)
+    return chain.xtra["residue_backbone"]
+
+
+def get_backbone_alignment(chain_1, chain_2):
+    """Returns two arrays with the indices (in each chain's backbone coordinates) of the backbone atoms of the residues
+    paired by get_residue_alignment, so missing loops or extra tails don't shift the pairs after them"""
+    residues_1 = get_residue_backbone_indices(chain_1)
+    residues_2 = get_residue_backbone_indices(chain_2)
+    pairs = np.array(get_residue_alignment(chain_1.get_sequence(), chain_2.get_sequence()), dtype=np.int64)
+    pairs = pairs.reshape(-1, 2)
+    index_1, index_2 = residues_1[pairs[:, 0]], residues_2[pairs[:, 1]]
+    both = (index_1 >= 0) & (index_2 >= 0)
+    return index_1[both], index_2[both]
+
+
+def get_template_rmsd(macrocomplex, template_chains):
+    """Returns the backbone RMSD between a model and a template (a list of chains with the unified ids) and the
+    number of template chains paired. The model is superimposed on the first template chain through each of its
+    chains with the same id (all the superpositions at once), and the one whose chain centers fit best the template's
+    is kept. Then each template chain is paired with the closest free model chain of its id, and the backbone atoms of
+    the residues aligned in all the pairs (see get_backbone_alignment) are superimposed together. The RMSD is None if
+    no chain can be paired"""
+    placements = list(macrocomplex)
+    model_ids = np.array([placement.id for placement in placements])
+    template_chains = [chain for chain in template_chains
+                       if chain.id in set(model_ids.tolist()) and len(chain.get_backbone_coords())]
+    if not template_chains:
+        return None, 0
+    model_templates = {id(placement.template): placement.template for placement in placements}.values()
+    alignments = {(number, id(model_template)): get_backbone_alignment(chain, model_template)  # Atom pairs by residue
+                  for number, chain in enumerate(template_chains) for model_template in model_templates
+                  if model_template.id == chain.id}
+    template = [chain.get_backbone_coords() for chain in template_chains]
+    model_coords = [macrocomplex.get_backbone_coords(number) for number in range(len(placements))]
+    anchors = np.flatnonzero(model_ids == template_chains[0].id)
+    anchor_pairs = [alignments[(0, id(placements[anchor].template))] for anchor in anchors]
+    superpositions = get_superpositions([(template[0][template_index], model_coords[anchor][model_index])
+                                         for anchor, (template_index, model_index) in zip(anchors, anchor_pairs)])
+    rots = np.array([rot for rot, tran in superpositions])
+    trans = np.array([tran for rot, tran in superpositions])
+    model_centers = np.einsum("mi,kij->kmj", macrocomplex.get_spheres()[0], rots) + trans[:, None, :]
+    template_centers = np.array([coords.mean(axis=0) for coords in template])
+    same_id = np.array([chain.id for chain in template_chains])[:, None] == model_ids[None, :]
+    distances = np.sqrt(((template_centers[None, :, None, :] - model_centers[:, None, :, :]) ** 2).sum(axis=3))
+    distances[:, ~same_id] = np.inf  # (anchor, template chain, model chain)
+    best = int(np.argmin(distances.min(axis=2).sum(axis=1)))  # The anchor that fits best all the template chains
+    pairs = []
+    paired_template, paired_model = set(), set()
+    for flat in np.argsort(distances[best], axis=None).tolist():  # Closest pairs first
+        template_number, model_number = divmod(flat, len(placements))
+        if not np.isfinite(distances[best, template_number, model_number]):
+            break
+        if template_number not in paired_template and model_number not in paired_model:
+            paired_template.add(template_number)
+            paired_model.add(model_number)
+            pairs.append((template_number, model_number))
+    atom_pairs = [alignments[(t, id(placements[m].template))] for t, m in pairs]
+    fixed = np.concatenate([template[t][template_index] for (t, m), (template_index, model_index)
+                            in zip(pairs, atom_pairs)])
+    moving = np.concatenate([model_coords[m][model_index] for (t, m), (template_index, model_index)
+                             in zip(pairs, atom_pairs)])
+    rot, tran = get_superposition(fixed, moving)
+    rmsd = float(np.sqrt(((np.dot(moving, rot) + tran - fixed) ** 2).sum(axis=1).mean()))
+    return rmsd, len(pairs)
+
+
+def score_model(macrocomplex, interacting_ids, stech_dict=None, template_chains=None):
+    """Returns a dictionary with the metrics of a model, computed from the backbone coordinates it keeps. All the
+    backbone atoms closer than INTERFACE_DISTANCE are found at once, and the pairs between different chains give:
+        clash_score: fraction of backbone atoms closer than CLASH_DISTANCE to another chain's backbone
+        interfaces: pairs of chains in contact whose ids interact in the input pairs (interacting_ids)
+    with the chains, the stoichiometry_deviation (sum of the differences with stech_dict, if given) and the
+    template_rmsd and template_chains paired (see get_template_rmsd, if template chains are given)"""
+    all_coords = macrocomplex.get_backbone_coords()
+    numbers = np.repeat(np.arange(len(macrocomplex)), np.diff(macrocomplex.backbone_starts))
+    index_1, index_2 = close_pairs(all_coords, all_coords, INTERFACE_DISTANCE)
+    other = numbers[index_1] < numbers[index_2]  # Each pair between two chains once
+    index_1, index_2 = index_1[other], index_2[other]
+    clashing = ((all_coords[index_1] - all_coords[index_2]) ** 2).sum(axis=1) <= CLASH_DISTANCE ** 2
+    clashing_atoms = np.unique(np.concatenate([index_1[clashing], index_2[clashing]]))
+    contacts = np.unique(numbers[index_1] * len(macrocomplex) + numbers[index_2])
+    ids = [placement.id for placement in macrocomplex]
+    interfaces = sum(1 for contact in contacts.tolist()
+                     if (ids[contact // len(macrocomplex)], ids[contact % len(macrocomplex)]) in interacting_ids)
+    score = {"model": macrocomplex.id,
+             "chains": len(macrocomplex),
+             "clash_score": len(clashing_atoms) / len(all_coords) if len(all_coords) else 0.0,
+             "interfaces": interfaces,
+             "stoichiometry_deviation": None,
+             "template_rmsd": None,
+             "template_chains": None}
+    if stech_dict:
+        profile = generate_model_profile(macrocomplex)
+        score["stoichiometry_deviation"] = sum(abs(profile.get(chain_id, 0) - stech_dict.get(chain_id, 0))
+                                               for chain_id in set(profile) | set(stech_dict))
+    if template_chains:
+        score["template_rmsd"], score["template_chains"] = get_template_rmsd(macrocomplex, template_chains)
+    return score
+
+
+def rank_models(scores):
+    """Returns the indices of the scores from the best model to the worst: by template RMSD (if any), deviation from
+    the stoichiometry (if any), clash score, satisfied interfaces, chains, and model order on ties"""
+    rmsds = np.array([np.inf if score["template_rmsd"] is None else score["template_rmsd"] for score in scores])
+    deviations = np.array([score["stoichiometry_deviation"] or 0 for score in scores])
+    clash_scores = np.array([score["clash_score"] for score in scores])
+    interfaces = np.array([score["interfaces"] for score in scores])
+    chains = np.array([score["chains"] for score in scores])
+    return np.lexsort((np.arange(len(scores)), -chains, -interfaces, clash_scores, deviations, rmsds)).tolist()
+
+
+def save_scores(scores, ranking, out_name):
+    """Prints the ranked table of the scores and saves it as a tab separated file"""
+    lines = ["\t".join(["rank"] + SCORE_COLUMNS)]
+    for rank, index in enumerate(ranking, 1):
+        values = [scores[index][column] for column in SCORE_COLUMNS]
+        lines.append("\t".join([str(rank)] + ["-" if value is None else "%.4f" % value if isinstance(value, float)
+                                                else str(value) for value in values]))
+    print("\n".join(lines))
+    with open(out_name, "w") as fh:
+        fh.write("\n".join(lines) + "\n")
+
+
+_save_state = dict()  # Models being saved and their options, set once by init_save_worker
+
+
+def init_save_worker(out_models, compress):
+    """Stores the models to save in the worker process. Workers are forked, so they get them without pickling"""
+    _save_state["models"] = out_models
+    _save_state["compress"] = compress
+
+
+def save_model_worker(index_name):
+    index, out_name = index_name
+    _save_state["models"][index].save_to_mmCIF(out_name, _save_state["compress"])
+
+
+def save_results(out_models, output, jobs=1, compress=False, numbers=None):
+    """Saves the resulting models into cif files (at the current working directory). Models are written by jobs
+    processes at the same time (formatting the rows is Python code, so threads would wait for each other), and
+    gzipped if compress is True. Model i is saved as output_i, unless the numbers to use are given"""
     print("Saving models...")
     path = os.getcwd()
-    for model in out_models:  # Saves all models in the current working directory
-        model.save_to_mmCIF(path+"/"+output + "_" + str(i))
-        i += 1
+    numbers = numbers or range(1, len(out_models) + 1)
+    out_names = [os.path.join(path, output + "_" + str(i)) for i in numbers]  # output can also be a path
+    if jobs > 1 and len(out_models) > 1:
+        with Pool(min(jobs, len(out_models)), initializer=init_save_worker, initargs=(out_models, compress)) as pool:
+            pool.map(save_model_worker, enumerate(out_names), chunksize=1)
+    else:
+        for model, out_name in zip(out_models, out_names):  # Saves all models in the current working directory
+            model.save_to_mmCIF(out_name, compress)
     print("Done\n")
 
 
-def main_loop(num_models, output, interaction_dict, verbose=False, max_chains=100, dirty=False,
-              stech_dict=False):
-    """Using the interaction dictionary, this function generates macrocomplex model/s. It begins with a template model
-    and starts adding chains until conditions allow. Finally it returns a list of pdb instance models."""
-    out_models = []
-    for i in range(1, num_models + 1):
-        print("Macrocomplex " + str(i) + " ...")
-        macrocomplex = get_starting_model(interaction_dict, verbose).copy()  # Selects a starting model
+def get_stop_reason(deadline, failures, max_failures):
+    """Returns why a model has to stop before its frontier is empty: its deadline (a time.perf_counter() value) passed
+    or max_failures candidates in a row were rejected. None if it can go on"""
+    if deadline is not None and time.perf_counter() >= deadline:
+        return "time budget reached"
+    if max_failures and failures >= max_failures:
+        return str(failures) + " candidates rejected in a row"
+    return None
+
+
+def add_symmetry_copies(macrocomplex, detector, sources, max_chains, model_stech, stech_dict, verbose=False,
+                        stats=None, progress=None, deadline=None, failures=0, max_failures=None):
+    """Places the copies of the source chains made by all the known symmetry operators, and then the copies of the
+    copies, until no new copy fits or the model runs out of its budgets (see get_stop_reason). The transforms of each
+    round of copies are computed at once, and the copies are checked together, against the model and against the
+    copies before them in the round (see evaluate_placements). Returns the list of (copy, chain it was copied from)
+    added and the failures in a row after them"""
+    added = []
+    operators = detector.operators
+    while sources and len(macrocomplex) < max_chains and not get_stop_reason(deadline, failures, max_failures):
+        rots, trans = apply_operators(sources, operators)
+        copies = [ChainPlacement(sources[number // len(operators)].template, rots[number], trans[number])
+                  for number in range(len(rots))]
+        checks = evaluate_placements(copies, macrocomplex, stats)
+        round_start = len(macrocomplex)  # Copies added in this round may clash with the next ones
+        new_sources = []
+        for number, copy in enumerate(copies):
+            if len(macrocomplex) >= max_chains or get_stop_reason(deadline, failures, max_failures):
+                break
+            source = sources[number // len(operators)]
+            if stech_dict and stech_dict.get(copy.id, 0) <= model_stech.get(copy.id, 0):  # Stoichiometry is full
+                if stats:
+                    stats.count("stoichiometry_rejections")
+                if progress:
+                    progress.emit("chain_rejected", model=macrocomplex.id, chain=copy.id, reason="stoichiometry")
+                failures += 1
+                continue
+            if macrocomplex.find_duplicate(copy) is not None:  # As most copies of a closed symmetry, not a failure
+                if stats:
+                    stats.count("duplicate_rejections")
+                if progress:
+                    progress.emit("chain_rejected", model=macrocomplex.id, chain=copy.id, reason="duplicate")
+                continue
+            if stats:
+                stats.count("symmetry_candidates")
+            clashes, move_coords = has_batch_clashes(copy, checks[number], copies, macrocomplex, round_start, stats)
+            if clashes:
+                if stats:
+                    stats.count("clash_rejections")
+                if progress:
+                    progress.emit("chain_rejected", model=macrocomplex.id, chain=copy.id, reason="clash")
+                failures += 1
+                continue
+            if verbose:
+                print("(Y) Chain " + str(len(macrocomplex)) + " added: symmetry copy of chain " + str(source.number) +
+                      " " + copy.id)
+            macrocomplex.add(copy, move_coords)
+            detector.add(copy)
+            if progress:
+                progress.emit("chain_added", model=macrocomplex.id, number=copy.number, chain=copy.id, symmetry=True)
+            model_stech[copy.id] = model_stech.get(copy.id, 0) + 1
+            new_sources.append(copy)
+            added.append((copy, source))
+            failures = 0
+        sources = new_sources
+    return added, failures
+
+
+def build_model(i, seed, interaction_graph, settings, stech_dict=False, superpositions=None, stats=None, progress=None,
+                checkpoint=None, state=None):
+    """Builds the macrocomplex model number i with the given seed, placing the chains of the frontier until it is
+    empty or a limit of the settings is reached. A state read from a checkpoint resumes the model where it was saved"""
+    rng = random.Random(seed)
+    if superpositions is None:
+        superpositions = dict()
+    start = time.perf_counter()
+    if stats:
+        num_superpositions = len(superpositions)
+    if state:  # The placed chains, frontier, counters and random generator of the checkpoint
+        macrocomplex, frontier, detector = restore_model_state(state, interaction_graph.chains, rng, settings.order)
+        model_stech = state["model_stech"]
+        stech_dict = state["stech_dict"]
+        start -= state["seconds"]
+        print("Macrocomplex " + str(i) + " (seed " + str(seed) + ") resumed from " + str(len(macrocomplex)) +
+              " chains ...")
+    else:
+        print("Macrocomplex " + str(i) + " (seed " + str(seed) + ") ...")
+        macrocomplex = MacroComplex("Model_" + str(i))
+    if progress:
+        progress.emit("model_started", model=macrocomplex.id, seed=seed, macrocomplex=macrocomplex)
+    trajectory = None
+    if settings.dirty:  # Logs each step in the building of the model, it can be replayed with MBreplay.py
+        trajectory = TrajectoryWriter(settings.output + str(i) + "_trajectory.jsonl", macrocomplex.id, seed,
+                                      state["trajectory_steps"] if state else None)
+    if not state:
+        for template in get_starting_model(interaction_graph, settings.verbose):  # Selects a starting model
+            macrocomplex.add(ChainPlacement(template))
+            if trajectory:
+                trajectory.add(macrocomplex.placements[-1])
         model_stech = generate_model_profile(macrocomplex)  # Generates the stechometry of the first two chains
-        macrocomplex.id = "Model_" + str(i)
-        run = True  # WHile this variable is true, the program will keep trying to add chains to the macrocomplex
-        num_of_chains = 2  # The model starts with 2 chains already
-        num_empty_chains = 0  # NUmber of chains that have all their interactions depleted
-        while run:
-            for chain in macrocomplex:  # Iterates the macrocomplex chains
-                if num_of_chains < max_chains:  # If the number of chains still hasn't reached the maximum allowed
-                    if chain.interactions:  # If this chain still has pending interactions
-                        random.shuffle(chain.interactions)  # Shuffle the interactions list (to avoid
-                        # repetitive behaviour)
-                        for inter_tple in chain.interactions:
-                            if stech_dict:  # If there is stechometry input (either as stirng or template pdb)
-                                target_chain_id = interaction_dict[chain.id][inter_tple][1].id  # chain to be added
-                                model_stech.setdefault(target_chain_id, 0)
-                                model_number_chain = model_stech[target_chain_id]  # Get the number of repetitions
-                                stech_dict.setdefault(target_chain_id, 0)
-                                if stech_dict[target_chain_id] <= model_number_chain:  # If the number of this target
-                                    # chain would surpass the stechemestry given, don't add the chain and
-                                    if verbose:
-                                        print("(S) Chain NOT added: interaction " + chain.id + ": " +
-                                            str(inter_tple[:1]) + " ... " + str(inter_tple[-1]) + " to " + target_chain_id)
-                                    continue # jump to the next interaction tuple
-                            fix, to_move = interaction_dict[chain.id][inter_tple]  # Get the interaction chain instances
-                            sup = Bio.PDB.Superimposer()  # Generates a superimposer instance
-                            chain_atoms, fix_atoms = chain.get_common_atoms(fix) # Get common atoms between the
-                            # macrocomplex chain and the one in the interaction dictionary
-                            sup.set_atoms(chain_atoms, fix_atoms)  # Generate the superposition
-                            move = to_move.copy()  # Make a copy of the chain to move
-                            sup.apply(move)  # Apply superposition matrix
-                            move_atoms = sorted(move.get_atoms())
-                            # Now it checks if the target chain has clashes with the model
-                            if not has_clashes(move_atoms, macrocomplex):  # If it hasn't
-                                if verbose:
-                                    print("Chain " + str(num_of_chains) + " added: interaction " + chain.id + ": " +
-                                          str(inter_tple[0]) + " ... " + str(inter_tple[-1]) + " to " + move.id)
-                                move.parent = None  # Sets the parent to none to evade biopython's strict id policy
-                                macrocomplex.add(move)  # Adds the target chain to the model
-                                model_stech.setdefault(move.id, 0)  # Updates stech dict
-                                model_stech[move.id] += 1
-                                num_of_chains += 1
-                                if dirty:  # Generates a cif file for each step in the building of the model
-                                    macrocomplex.save_to_mmCIF(output + str(i) + "_tmp_" + str(num_of_chains))
-                            elif verbose:  # If it has don't add the target chain
-                                print("Chain NOT added: interaction " + chain.id + ": " +
-                                      str(inter_tple[:1]) + " ... " + str(inter_tple[-1]) + " to " + move.id)
-                        chain.interactions = False  # Set the interaction attribute to 0, this chain now will be ignored
-                    else:
-                        if verbose:
-                            print("Chain " + chain.id + " empty")
-                        num_empty_chains += 1
-                else:
-                    run = False  # When the maximum chain treshold is reached stop running
+        frontier = Frontier(settings.order, rng)  # Placed chains that still have interactions to try
+        detector = SymmetryDetector() if settings.symmetry else None
+        for placement in macrocomplex:
+            if placement.interactions:
+                frontier.push(placement)
+            if detector:
+                detector.observe(placement)
+    if checkpoint:
+        template_index = {id(template): number for number, template in enumerate(interaction_graph.chains)}
+    finished = bool(state and state["finished"])  # A finished model of a checkpoint is only restored
+    stop_reason = None  # Budget that stopped the model before its frontier was empty
+    deadline = start + settings.time_budget if settings.time_budget else None
+    failures = state.get("failures", 0) if state else 0  # Candidates rejected since the last chain was added
+    while not finished and frontier and len(macrocomplex) < settings.max_chains and \
+            not stoichiometry_met(model_stech, stech_dict):
+        if progress and progress.cancelled:  # Stops between two chains, the model is consistent
+            break
+        if checkpoint and checkpoint.due():
+            checkpoint.save(get_model_state(macrocomplex, template_index, frontier, model_stech, stech_dict, rng,
+                                            detector, trajectory, time.perf_counter() - start, failures=failures))
+            if stats:
+                stats.count("checkpoints")
+        chain = frontier.pop()
+        if stats:
+            stats.count("chains_expanded")
+        rng.shuffle(chain.interactions)  # Shuffle the interactions list (to avoid repetitive behaviour)
+        for edge in chain.interactions:  # Interactions are edges of the interaction graph
+            if len(macrocomplex) >= settings.max_chains:  # The maximum number of chains is reached
+                break
+            stop_reason = get_stop_reason(deadline, failures, settings.max_failures)  # The model so far is returned
+            if stop_reason:
+                break
+            inter_tple = interaction_graph.keys[edge]  # Interacting residues of the chain
+            if stech_dict:  # If there is stechometry input (either as stirng or template pdb)
+                # The chain to be added is known before superimposing anything
+                target_chain_id = interaction_graph.target_ids[edge]
+                model_stech.setdefault(target_chain_id, 0)
+                model_number_chain = model_stech[target_chain_id]  # Get the number of repetitions
+                stech_dict.setdefault(target_chain_id, 0)
+                if stech_dict[target_chain_id] <= model_number_chain:  # If the number of this target
+                    # chain would surpass the stechemestry given, don't add the chain and
+                    if stats:
+                        stats.count("stoichiometry_rejections")
+                    if progress:
+                        progress.emit("chain_rejected", model=macrocomplex.id, chain=target_chain_id,
+                                      reason="stoichiometry")
+                    if settings.verbose:
+                        print("(S) Chain NOT added: interaction " + chain.id + ": " +
+                              str(inter_tple[:1]) + " ... " + str(inter_tple[-1]) + " to " + target_chain_id)
+                    failures += 1
+                    continue # jump to the next interaction tuple
+            fix, to_move = interaction_graph.get_chains(edge)  # Get the interaction chain instances
+            rot, tran = get_placement_transform(chain, fix, superpositions)  # Superposition matrix
+            move = ChainPlacement(to_move, rot, tran)  # Only a reference to the chain to move
+            if stats:
+                stats.count("superpositions")
+            # A chain with the same id and pose, found in O(1) from the transformation, before moving any atom
+            duplicate = macrocomplex.find_duplicate(move)
+            if duplicate is not None:
+                if stats:
+                    stats.count("duplicate_rejections")
+                if progress:
+                    progress.emit("chain_rejected", model=macrocomplex.id, chain=move.id, reason="duplicate")
+                if settings.verbose:
+                    print("(D) Chain NOT added: interaction " + chain.id + ": " + str(inter_tple[:1]) + " ... " +
+                          str(inter_tple[-1]) + " to " + move.id + ", already placed as chain " + str(duplicate.number))
+                failures += 1
+                continue
+            # Now it checks if the target chain has clashes with the model (only its backbone is moved)
+            move_coords = move.get_backbone_coords()
+            if stats:
+                stats.count("atoms_copied", len(move_coords))
+            if not has_clashes(move_coords, macrocomplex, move.get_bounding_sphere(), stats):  # If it hasn't
+                if settings.verbose:
+                    print("Chain " + str(len(macrocomplex)) + " added: interaction " + chain.id + ": " +
+                          str(inter_tple[0]) + " ... " + str(inter_tple[-1]) + " to " + move.id)
+                macrocomplex.add(move, move_coords)  # Adds the target chain to the model
+                failures = 0
+                if progress:
+                    progress.emit("chain_added", model=macrocomplex.id, number=move.number, chain=move.id,
+                                  symmetry=False)
+                model_stech.setdefault(move.id, 0)  # Updates stech dict
+                model_stech[move.id] += 1
+                if move.interactions:  # The new chain will try its own interactions
+                    frontier.push(move)
+                if trajectory:  # Only the added chain is written
+                    trajectory.add(move, chain, inter_tple)
+                if detector:  # The symmetry copies of the new chain are placed at once
+                    operators = detector.observe(move)
+                    sources = [move]
+                    if operators:  # New operators, they also make copies of all the previous chains
+                        sources = list(macrocomplex)
+                        if stats:
+                            stats.count("symmetry_operators", len(operators))
+                    if detector.operators:
+                        # Copies don't join the frontier: what their interactions would add are the copies of what
+                        # the interactions of their source add, which are placed by the symmetry too. Trying them
+                        # anyway made closed symmetries 60% slower without a single new chain. In open (helical)
+                        # assemblies, the rounds of copies extend the chains placed so far along the axis, so a model
+                        # capped by max_chains is longer and less connected than the one of the default path
+                        copies, failures = add_symmetry_copies(macrocomplex, detector, sources, settings.max_chains,
+                                                               model_stech, stech_dict, settings.verbose, stats,
+                                                               progress, deadline, failures, settings.max_failures)
+                        if trajectory:
+                            for copy, source in copies:
+                                trajectory.add(copy, source)
+                        # Also ran out while copying
+                        stop_reason = get_stop_reason(deadline, failures, settings.max_failures)
+                        if stop_reason:
+                            break
+                if stoichiometry_met(model_stech, stech_dict):  # The interactions left would all be rejected
                     break
-            if num_empty_chains >= len(macrocomplex):  # If all chains are empty of interactions stop running
-                run = False
-        if verbose:
-            stechometry_string = ""  # Print the model's stechometry
-            for key in sorted(model_stech.keys()):
-                stechometry_string += key + ":" + str(model_stech[key]) + ","
-            stechometry_string = stechometry_string[:-1]
-            print("Macrocomplex's"+str(i)+" Stoichiometry is: "+stechometry_string)
-        print("Macrocomplex " + str(i) + " finished")
+            else:  # If it has don't add the target chain
+                if stats:
+                    stats.count("clash_rejections")
+                if progress:
+                    progress.emit("chain_rejected", model=macrocomplex.id, chain=move.id, reason="clash")
+                if settings.verbose:
+                    print("Chain NOT added: interaction " + chain.id + ": " +
+                          str(inter_tple[:1]) + " ... " + str(inter_tple[-1]) + " to " + move.id)
+                failures += 1
+        chain.interactions = []  # All its interactions were tried, this chain leaves the frontier
+        if stop_reason:
+            break
+    if stop_reason:
+        print("Macrocomplex " + str(i) + " stopped with " + str(len(macrocomplex)) + " chains: " + stop_reason)
+        if stats:
+            stats.count("budget_stops")
+    if checkpoint:  # A cancelled model is saved where it stopped, to be resumed
+        checkpoint.save(get_model_state(macrocomplex, template_index, frontier, model_stech, stech_dict, rng,
+                                        detector, trajectory, time.perf_counter() - start,
+                                        finished=not (progress and progress.cancelled), failures=failures))
+        if stats:
+            stats.count("checkpoints")
+    if settings.verbose:
+        stechometry_string = ""  # Print the model's stechometry
+        for key in sorted(model_stech.keys()):
+            stechometry_string += key + ":" + str(model_stech[key]) + ","
+        stechometry_string = stechometry_string[:-1]
+        print("Macrocomplex's"+str(i)+" Stoichiometry is: "+stechometry_string)
+    if trajectory:
+        trajectory.close()
+    if stats:
+        stats.count("superpositions_computed", len(superpositions) - num_superpositions)  # Not found in the cache
+        stats.count("chains_added", len(macrocomplex))
+        stats.add_model(i, seed, time.perf_counter() - start, len(macrocomplex))
+    if progress and not progress.cancelled:  # A cancelled model is not finished, main_loop discards it
+        progress.emit("model_finished", model=macrocomplex.id, chains=len(macrocomplex),
+                      seconds=time.perf_counter() - start, macrocomplex=macrocomplex)
+    print("Macrocomplex " + str(i) + " finished")
+    return macrocomplex
+
+
+def compact_model(macrocomplex, template_index):
+    """Packs a macrocomplex as its id and a list of (template number, rotation, translation), to send it between
+    processes without the template chains"""
+    return macrocomplex.id, [(template_index[id(placement.template)], placement.rot, placement.tran)
+                             for placement in macrocomplex]
+
+
+def expand_model(record, templates):
+    """Rebuilds a macrocomplex packed by compact_model"""
+    model_id, placements = record
+    macrocomplex = MacroComplex(model_id)
+    for template_number, rot, tran in placements:
+        macrocomplex.add(ChainPlacement(templates[template_number], rot, tran))
+    return macrocomplex
+
+
+def get_model_checkpoint(output, i, checkpoint=False, resume=False):
+    """Returns the CheckpointWriter of the model number i (None without checkpoints) and, to resume it, the state
+    saved in its checkpoint (None if the model wasn't started)"""
+    if not (checkpoint or resume):
+        return None, None
+    path = get_model_checkpoint_path(output, i)
+    return CheckpointWriter(path), read_checkpoint(path) if resume else None
+
+
+def get_resume_seed(output, seed, settings):
+    """Returns the seed of the build saved in the checkpoint of output, after checking that it was built with the
+    same settings (and seed, if one is given), as otherwise resuming it would not give the same models"""
+    header = read_build_checkpoint(output)
+    if header is None:
+        sys.stderr.write("There is no checkpoint of " + output + " to resume, run the build with checkpoints first\n")
+        sys.exit(1)
+    settings = json.loads(json.dumps(settings))  # As read from the checkpoint (lists instead of tuples)
+    changed = [name for name in sorted(settings) if header.get(name) != settings[name]]
+    if seed is not None and seed != header["seed"]:
+        changed.append("seed")
+    if changed:
+        sys.stderr.write("The checkpoint of " + output + " can't be resumed with a different " + ", ".join(changed) +
+                         "\n")
+        sys.exit(1)
+    return header["seed"]
+
+
+_worker_state = dict()  # Read-only data of the model building processes, set once by init_model_worker
+
+
+def init_model_worker(interaction_graph, settings, stech_dict, with_stats=False):
+    """Stores the data shared by all the models in the worker process"""
+    _worker_state["interaction_graph"] = interaction_graph
+    _worker_state["settings"] = settings
+    _worker_state["stech_dict"] = stech_dict
+    _worker_state["with_stats"] = with_stats
+    _worker_state["template_index"] = {id(template): number
+                                       for number, template in enumerate(interaction_graph.chains)}
+    _worker_state["superpositions"] = dict()
+
+
+def build_model_worker(model_seed):
+    """Builds a model in a worker process and returns it packed, with its stats (None if they are not collected)"""
+    i, seed = model_seed
+    settings = _worker_state["settings"]
+    stech_dict = _worker_state["stech_dict"]
+    stech_dict = dict(stech_dict) if stech_dict else stech_dict
+    stats = BuildStats() if _worker_state["with_stats"] else None
+    checkpoint, state = get_model_checkpoint(settings.output, i, settings.checkpoint, settings.resume)
+    macrocomplex = build_model(i, seed, _worker_state["interaction_graph"], settings, stech_dict,
+                               _worker_state["superpositions"], stats, checkpoint=checkpoint, state=state)
+    return compact_model(macrocomplex, _worker_state["template_index"]), stats and stats.to_dict()
+
+
+def main_loop(interaction_graph, settings, stech_dict=False, stats=None, progress=None):
+    """Using the interaction graph, this function generates the macrocomplex models (model i uses the seed seed + i - 1)
+    and returns a list of MacroComplex models, the ones finished until then if the build is cancelled"""
+    output, num_models, jobs = settings.output, settings.num_models, settings.jobs
+    header = dict(settings.get_model_settings(), stech_dict=stech_dict,
+                  chains=[chain.id for chain in interaction_graph.chains],
+                  interactions=len(interaction_graph))  # Templates are numbered by the interaction graph
+    seed = settings.seed
+    if settings.resume:
+        seed = get_resume_seed(output, seed, header)
+    if seed is None:
+        seed = random.randrange(2 ** 31)
+    if settings.checkpoint or settings.resume:
+        save_build_checkpoint(output, dict(header, seed=seed))
+    model_seeds = [(i, seed + i - 1) for i in range(1, num_models + 1)]
+    if jobs > 1 and num_models > 1:
+        templates = interaction_graph.chains
+        out_models = []
+        with Pool(min(jobs, num_models), initializer=init_model_worker,
+                  initargs=(interaction_graph, settings, stech_dict, bool(stats))) as pool:
+            for record, model_stats in pool.imap(build_model_worker, model_seeds):
+                out_models.append(expand_model(record, templates))
+                if stats:
+                    stats.merge(model_stats)
+                if progress:
+                    progress.emit("model_finished", model=out_models[-1].id, chains=len(out_models[-1]), seconds=None,
+                                  macrocomplex=out_models[-1])
+                    if progress.cancelled:  # Leaving the block terminates the processes
+                        break
+        return out_models
+    out_models = []
+    superpositions = dict()  # Superpositions between template chains, shared by all models
+    for i, model_seed in model_seeds:
+        model_stech_dict = dict(stech_dict) if stech_dict else stech_dict
+        model_checkpoint, state = get_model_checkpoint(output, i, settings.checkpoint, settings.resume)
+        macrocomplex = build_model(i, model_seed, interaction_graph, settings, model_stech_dict, superpositions,
+                                   stats, progress, model_checkpoint, state)
+        if progress and progress.cancelled:  # The unfinished model is discarded
+            break
         out_models.append(macrocomplex)  # Add model to the models list
     return out_models
 
-def get_template_stech_dict(template, seq_dict, verbose=False):
-    """Generates a stechometry dictionary for a given pdb template"""
-    template_stech_dict = {}  # Format: { "A": 2, "B": 3, ...}, where key is chain id and value
-    # is the number of repetitions
+def get_template_chains(template, seq_dict):
+    """Returns the chains of a pdb template whose sequence is one of the input chains, with the unified ids"""
+    template_chains = []
     parser = PDBParser(PERMISSIVE=1, QUIET=True)
     template_object = parser.get_structure("template", template)[0]  # Generates pdb template object
     for chain in template_object:
@@ -296,8 +1230,17 @@ def get_template_stech_dict(template, seq_dict, verbose=False):
         chain_seq = chain.get_sequence()
         if chain_seq in seq_dict:
             chain.id = seq_dict[chain_seq]  # Updates the template chain id to the corresponding by its sequence
-            template_stech_dict.setdefault(chain.id, 0)
-            template_stech_dict[chain.id] += 1  # Adds to chain id counter
+            template_chains.append(chain)
+    return template_chains
+
+
+def get_template_stech_dict(template, seq_dict, verbose=False, template_chains=None):
+    """Generates a stechometry dictionary for a given pdb template (or its chains, if get_template_chains already
+    read them)"""
+    if template_chains is None:
+        template_chains = get_template_chains(template, seq_dict)
+    # Format: { "A": 2, "B": 3, ...}, where key is chain id and value is the number of repetitions
+    template_stech_dict = generate_model_profile(template_chains)
     if verbose:  # Transforms the stech_dict to a string to be printed
         stechometry_string = ""
         for key in sorted(template_stech_dict.keys()):
@@ -320,34 +1263,105 @@ def get_string_stech_dict(stech_string):
         sys.exit(1)
 
 
-def build_macrocomplex(directory, output, max_chains=300, num_models=1, template=False, dirty=False, verbose=False, stech_string=False):
-    """Main function that integrates all the important steps. First it reads the pdb models ans stores them in a list.
-    Then it compares all the chains and unifies the chain ids of the pdb list updating them, it also generates a sequence
-    key dictionary. Then it checks at each pdb model for chain interactions and stores them in a dictionary. After it
-    updates the dictionary with information of itself. Next it generates the model/s using this interactions. Finally it
-    saves the model/s in cif format."""
-    print("Program is running, please wait...")
+def prepare_inputs(directory, verbose=False, jobs=1, use_cache=True, interface_rmsd=INTERFACE_RMSD, stats=None,
+                   progress=None):
+    """Reads the pdb models of the input directory, unifies their chain ids by sequence, finds the interactions of
+    each pair, removes the redundant ones (see remove_redundant_interactions) and indexes them as an InteractionGraph.
+    Returns the sequence dictionary {sequence: chain id} and the interaction graph, which can be used by any number of
+    builds (see build_models). With jobs bigger than 1, the input files are read by a pool of processes, and unless
+    use_cache is False the preprocessed files are stored in an on-disk cache to be reused by the next runs."""
+    cache = None
+    if use_cache:  # The cached results are only valid for the same thresholds
+        cache = PDBCache(thresholds=(IDENTITY_THRESHOLD, CONTACT_DISTANCE))
     # Reads and stores pdb objects in a list
-    in_pdbmodels = read_pdbs(directory, verbose)
+    with timed_stage(stats, "read_pdbs", progress):
+        in_pdbmodels = read_pdbs(directory, verbose, jobs, cache)
     # Unifies all ids by sequence, updates the pdb list with new chain ids and returns a sequence dictionary: {seq: id,}
-    seq_dict = unify_ids(in_pdbmodels, verbose)
+    with timed_stage(stats, "unify_ids", progress):
+        seq_dict = unify_ids(in_pdbmodels, verbose, cache)
     # Checks each pdb object for chain interactions and stores it in a dictionary of dictionaries:
     # {
     #   Chain1_id : { residues_tuple_1_to_2 : chain1_object, chain2_object, residues_tuple_2_to_1}
     #   Chain2_id : {residues_tuple_2_to_1 : chain2_object, chain1_object, residues_tuple_1_to_2}
     #   ...
     # }
-    interaction_dict = get_interaction_dict(in_pdbmodels, verbose=verbose)
-    # Changes interaction_dict chain objects to CustomChain instances and adds the interactions to each instance
-    update_interactions_dict(interaction_dict, verbose)
+    with timed_stage(stats, "get_interaction_dict", progress):
+        interaction_dict = get_interaction_dict(in_pdbmodels, verbose=verbose)
+    if interface_rmsd > 0:  # Removes the interactions that would place the same chains as others
+        with timed_stage(stats, "remove_redundant_interactions", progress):
+            removed = remove_redundant_interactions(interaction_dict, interface_rmsd, verbose)
+        print("%s redundant interactions collapsed" % removed)
+        if stats:
+            stats.count("interactions_collapsed", removed)
+    # Indexes the interactions as the edges of a graph and adds to each chain the edges it can try
+    with timed_stage(stats, "get_interaction_graph", progress):
+        interaction_graph = get_interaction_graph(interaction_dict, verbose)
+    return seq_dict, interaction_graph
+
+
+def build_models(interaction_graph, seq_dict, settings, stats=None, progress=None):
+    """Builds the models from the inputs returned by prepare_inputs with a BuildSettings, scores them if asked and
+    saves them (see build_macrocomplex). The interaction graph is only read, so it can be shared by several builds.
+    Returns the scores of the saved models, from the best ranked one (None if they were not scored)"""
+    output = settings.output
     stech_dict = {}
+    template_chains = None
     # If a template or a string has been given to set Stoichometry, it generates a dictionary of it
     # { "A":5, "B":2, "C":6, .. }
-    if template:
-        stech_dict = get_template_stech_dict(template, seq_dict, verbose=verbose)
-    elif stech_string:
-        stech_dict = get_string_stech_dict(stech_string)
+    if settings.template:
+        template_chains = get_template_chains(settings.template, seq_dict)  # Also used to score the models
+        stech_dict = get_template_stech_dict(settings.template, seq_dict, verbose=settings.verbose,
+                                             template_chains=template_chains)
+    elif settings.stech_string:
+        stech_dict = get_string_stech_dict(settings.stech_string)
     # Starts iterating the interaction pair with more known interactions and generates the model/s
-    out_pdbmodels = main_loop(num_models, output, interaction_dict, verbose, max_chains, dirty, stech_dict=stech_dict)
+    profiler = cProfile.Profile() if settings.profile_file else None
+    with timed_stage(stats, "main_loop", progress):
+        if profiler:
+            profiler.enable()
+        out_pdbmodels = main_loop(interaction_graph, settings, stech_dict, stats, progress)
+        if profiler:
+            profiler.disable()
+    if progress and progress.cancelled:
+        print("Build cancelled, %s finished models will be saved" % len(out_pdbmodels))
+        if settings.checkpoint or settings.resume:
+            print("It can be resumed from its checkpoints with the same output name")
+    if profiler:  # Only this process is profiled, models built by other processes are not included
+        profiler.dump_stats(settings.profile_file)
+        print("Profile saved to " + settings.profile_file)
+    scores = None
+    numbers = None
+    top = settings.top
+    if settings.score or top:  # Scores and ranks the models, so only the best ones are saved
+        with timed_stage(stats, "score_models", progress):
+            interacting_ids = interaction_graph.get_interacting_ids()
+            scores = [score_model(model, interacting_ids, stech_dict, template_chains) for model in out_pdbmodels]
+            ranking = rank_models(scores)
+            save_scores(scores, ranking, output + "_scores.tsv")
+        if top:
+            ranking = ranking[:top]
+            print("Saving the %s best ranked models" % len(ranking))
+            numbers = [index + 1 for index in ranking]  # Model i is the i-th one
+            out_pdbmodels = [out_pdbmodels[index] for index in ranking]
+        scores = [scores[index] for index in ranking]
     # Saves the model/s to ciff format
-    save_results(out_pdbmodels, output)
+    with timed_stage(stats, "save_results", progress):
+        save_results(out_pdbmodels, output, settings.jobs, settings.compress, numbers)
+    if (settings.checkpoint or settings.resume) and not (progress and progress.cancelled):  # Nothing left to resume
+        remove_checkpoints(output, settings.num_models)
+    return scores
+
+
+def build_macrocomplex(directory, settings, use_cache=True, interface_rmsd=INTERFACE_RMSD, stats_file=None,
+                       progress=None):
+    """Main function that integrates all the important steps: it reads and prepares the inputs of the directory, then
+    builds, scores and saves the models with the given BuildSettings (see MBlauncher.py for the options)"""
+    print("Program is running, please wait...")
+    stats = BuildStats() if stats_file else None
+    seq_dict, interaction_graph = prepare_inputs(directory, settings.verbose, settings.jobs, use_cache, interface_rmsd,
+                                                 stats, progress)
+    build_models(interaction_graph, seq_dict, settings, stats, progress)
+    if stats:
+        stats.save(stats_file)
+        print("Stats saved to " + stats_file)
+    return stats
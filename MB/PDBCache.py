@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# coding=utf-8
+import hashlib
+import os
+import pickle
+
+CACHE_VERSION = 2  # Increase it when the format of the stored records changes, so old entries are never used
+
+
+class PDBCache(object):
+    """On-disk cache of preprocessed input files. Each entry is a pickle file named by a hash of its content and the
+    thresholds used to compute it, so a changed file or threshold simply doesn't match any entry. When the cache
+    grows over max_size bytes, the least recently used entries are removed."""
+    def __init__(self, path=None, max_size=1024 ** 3, thresholds=()):
+        if path is None:
+            path = os.environ.get("MB_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "MacroBuilder"))
+        self.path = path
+        self.max_size = max_size
+        self.thresholds = tuple(thresholds)  # Values that change the cached results (identity, contact distance...)
+
+    def file_key(self, file_path):
+        """Returns the key of an input file: a hash of its content, the thresholds and the cache version"""
+        digest = hashlib.sha256(("%s %s " % (CACHE_VERSION, self.thresholds)).encode())
+        with open(file_path, "rb") as fh:
+            digest.update(fh.read())
+        return digest.hexdigest()
+
+    def group_key(self, keys, *extra):
+        """Returns a key for a result that depends on several files (in this order) and other extra values"""
+        digest = hashlib.sha256(("%s %s %s " % (CACHE_VERSION, self.thresholds, extra)).encode())
+        for key in keys:
+            digest.update(key.encode())
+        return digest.hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key + ".pkl")
+
+    def get(self, key):
+        """Returns the stored value of a key, or None if it isn't in the cache"""
+        entry = self._entry_path(key)
+        try:
+            with open(entry, "rb") as fh:
+                value = pickle.load(fh)
+            os.utime(entry)  # Marks the entry as recently used
+            return value
+        except OSError:  # Missing entry
+            return None
+        except Exception:  # Damaged entry, unpickling it can raise almost anything: it is dropped and parsed again
+            try:
+                os.remove(entry)
+            except OSError:
+                pass
+            return None
+
+    def put(self, key, value, evict=True):
+        """Stores a value. The cache is only a speed up, so if it can't be written the value is just not stored.
+        Eviction lists the whole cache, so whoever stores many values at once should pass evict=False and call evict
+        after the last one"""
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            tmp_entry = self._entry_path(key) + ".%s.tmp" % os.getpid()
+            with open(tmp_entry, "wb") as fh:
+                pickle.dump(value, fh, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_entry, self._entry_path(key))  # Other runs never see a half written entry
+        except OSError:
+            return
+        if evict:
+            self.evict()
+
+    def evict(self):
+        """Removes the least recently used entries until the cache is smaller than max_size"""
+        try:
+            entries = [os.path.join(self.path, f) for f in os.listdir(self.path) if f.endswith(".pkl")]
+            stats = [(os.stat(entry), entry) for entry in entries]
+        except OSError:
+            return
+        total = sum(stat.st_size for stat, entry in stats)
+        for stat, entry in sorted(stats, key=lambda x: x[0].st_mtime):  # Oldest used first
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(entry)
+                total -= stat.st_size
+            except OSError:
+                pass
+
+    def clear(self):
+        """Removes all the entries of the cache"""
+        max_size = self.max_size
+        self.max_size = -1
+        self.evict()
+        self.max_size = max_size
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# coding=utf-8
+import queue
+import threading
+
+
+class ProgressEvents(object):
+    """Thread-safe channel of progress events from a build to whoever shows them (the GUI). Events are (kind, data)
+    tuples put in a queue by the building thread and taken in batches by the other one, which can also ask the build
+    to stop with cancel. The build checks cancelled between steps, so it stops at a consistent point. Kinds are:
+        stage: a pipeline stage started (name)
+        model_started: a model started (model, seed, macrocomplex: the MacroComplex being built)
+        chain_added: a chain was placed (model, number, chain, symmetry)
+        chain_rejected: a candidate chain was rejected (model, chain, reason: clash, duplicate or stoichiometry)
+        model_finished: a model was finished (model, chains, seconds, macrocomplex)
+    Any other kind can be used to send results to the GUI thread."""
+    def __init__(self):
+        self.events = queue.Queue()
+        self.cancel_event = threading.Event()
+
+    def emit(self, kind, **data):
+        self.events.put((kind, data))
+
+    def drain(self, max_events=1000):
+        """Returns the list of pending events (up to max_events), without waiting"""
+        events = []
+        while len(events) < max_events:
+            try:
+                events.append(self.events.get_nowait())
+            except queue.Empty:
+                break
+        return events
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# coding=utf-8
+import numpy as np
+
+# The 27 cells (the cell itself and its neighbours) where a point closer than the cell size can be
+NEIGHBOUR_OFFSETS = np.array([(x, y, z) for x in (-1, 0, 1) for y in (-1, 0, 1) for z in (-1, 0, 1)], dtype=np.int64)
+CLOSE_CHUNK = 4096  # Points compared at once by close_pairs, with their 27 neighbour cells (it bounds the memory)
+
+
+def boxes_overlap(coords_1, coords_2, margin):
+    """Checks if the bounding boxes of two sets of coordinates, enlarged by margin, overlap"""
+    return bool(np.all(coords_1.min(axis=0) - margin <= coords_2.max(axis=0)) and
+                np.all(coords_2.min(axis=0) - margin <= coords_1.max(axis=0)))
+
+
+def close_pairs(coords_1, coords_2, cutoff):
+    """Returns two index arrays (i, j) with all the pairs of points coords_1[i], coords_2[j] that are at a distance
+    of cutoff or less. Points are binned in a grid of cubic cells of side cutoff, so only points in neighbour cells
+    are compared, and all the work is done with bulk numpy operations: the points of coords_1 are taken by chunks of
+    CLOSE_CHUNK, with their 27 neighbour cells at once"""
+    coords_1 = np.asarray(coords_1, dtype=np.float64).reshape(-1, 3)
+    coords_2 = np.asarray(coords_2, dtype=np.float64).reshape(-1, 3)
+    empty = np.zeros(0, dtype=np.int64)
+    if not len(coords_1) or not len(coords_2) or not boxes_overlap(coords_1, coords_2, cutoff):
+        return empty, empty
+    origin = np.minimum(coords_1.min(axis=0), coords_2.min(axis=0))
+    cells_1 = np.floor((coords_1 - origin) / cutoff).astype(np.int64) + 1  # +1 so neighbour cells are never negative
+    cells_2 = np.floor((coords_2 - origin) / cutoff).astype(np.int64) + 1
+    dims = np.maximum(cells_1.max(axis=0), cells_2.max(axis=0)) + 2
+    keys_1 = (cells_1[:, 0] * dims[1] + cells_1[:, 1]) * dims[2] + cells_1[:, 2]  # One integer per cell
+    keys_2 = (cells_2[:, 0] * dims[1] + cells_2[:, 1]) * dims[2] + cells_2[:, 2]
+    offsets = (NEIGHBOUR_OFFSETS[:, 0] * dims[1] + NEIGHBOUR_OFFSETS[:, 1]) * dims[2] + NEIGHBOUR_OFFSETS[:, 2]
+    order = np.argsort(keys_2, kind="stable")
+    sorted_keys = keys_2[order]
+    order_1 = np.argsort(keys_1, kind="stable")  # Sorted queries make the binary searches cache friendly
+    sorted_keys_1 = keys_1[order_1]
+    pairs_1, pairs_2 = [], []
+    cutoff_sq = cutoff * cutoff
+    for start in range(0, len(coords_1), CLOSE_CHUNK):
+        chunk_keys = sorted_keys_1[start:start + CLOSE_CHUNK]
+        keys = (offsets[:, None] + chunk_keys[None, :]).ravel()  # Neighbour cells, sorted for each offset
+        starts = np.searchsorted(sorted_keys, keys, side="left")
+        counts = np.searchsorted(sorted_keys, keys, side="right") - starts  # Points of coords_2 in each cell
+        hits = np.nonzero(counts)[0]
+        if not len(hits):
+            continue
+        counts = counts[hits]
+        index_1 = np.repeat(order_1[start + hits % len(chunk_keys)], counts)
+        # Position of each pair inside its cell: 0, 1, ... count - 1
+        within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        index_2 = order[np.repeat(starts[hits], counts) + within]
+        diff = coords_1[index_1] - coords_2[index_2]
+        close = np.einsum("ij,ij->i", diff, diff) <= cutoff_sq
+        pairs_1.append(index_1[close])
+        pairs_2.append(index_2[close])
+    if not pairs_1:
+        return empty, empty
+    return np.concatenate(pairs_1), np.concatenate(pairs_2)
+
+
+class SpatialHash(object):
+    """Uniform grid of points that can grow incrementally. The cell keys of the points (cells of side cell_size) are
+    kept sorted with the indices of the points, so the points of a cell are a slice found with a binary search, and
+    finding the points close to a query only needs to look at the 27 cells around it. A query is a few array
+    operations whatever its size, and its cost depends on the number of query points, not on the points stored.
+    Merging each new batch into one sorted array would copy all the stored keys every time, so they are kept in a few
+    sorted runs, from the biggest to the smallest: each batch is a new run, merged with the previous ones while they
+    are less than merge_ratio times bigger. Each point is merged O(log n) times and there are O(log n) runs to search."""
+    key_shift = 2 ** 20  # Cells are shifted to be positive, and packed in one integer of 21 bits per axis
+    merge_ratio = 8  # Minimum ratio between the sizes of two consecutive runs
+
+    def __init__(self, cell_size):
+        self.cell_size = float(cell_size)
+        self.runs = []  # (sorted cell keys, index of the point of each key) of each run
+        self.coords = np.zeros((0, 3), dtype=np.float64)
+        self.size = 0  # Number of points stored (self.coords has extra room to grow)
+
+    def __len__(self):
+        return self.size
+
+    def get_keys(self, cells):
+        """Packs an array of integer cells (n, 3) into an array of integer keys"""
+        cells = cells + self.key_shift
+        return (cells[..., 0] << 42) | (cells[..., 1] << 21) | cells[..., 2]
+
+    def add(self, coords):
+        """Adds an array of points (n, 3) to the grid"""
+        coords = np.asarray(coords, dtype=np.float64).reshape(-1, 3)
+        new_size = self.size + len(coords)
+        if new_size > len(self.coords):  # Doubles the storage, so adding points is amortized O(n)
+            storage = np.zeros((max(new_size, 2 * len(self.coords)), 3), dtype=np.float64)
+            storage[:self.size] = self.coords[:self.size]
+            self.coords = storage
+        self.coords[self.size:new_size] = coords
+        keys = self.get_keys(np.floor(coords / self.cell_size).astype(np.int64))
+        order = np.argsort(keys, kind="stable")
+        keys, points = keys[order], order + self.size
+        while self.runs and len(self.runs[-1][0]) < self.merge_ratio * len(keys):
+            run_keys, run_points = self.runs.pop()
+            positions = np.searchsorted(run_keys, keys, side="right")  # After the same keys of the older run
+            keys, points = np.insert(run_keys, positions, keys), np.insert(run_points, positions, points)
+        if len(keys):
+            self.runs.append((keys, points))
+        self.size = new_size
+
+    def has_neighbours(self, coords, radius=None):
+        """Returns a boolean array telling, for each point of coords, if there is a stored point at radius or less
+        (radius can't be bigger than the cell size)"""
+        coords = np.asarray(coords, dtype=np.float64).reshape(-1, 3)
+        found = np.zeros(len(coords), dtype=bool)
+        if not len(coords) or not self.size:
+            return found
+        radius = self.cell_size if radius is None else radius
+        cells = np.floor(coords / self.cell_size).astype(np.int64)
+        keys = self.get_keys(cells[:, None, :] + NEIGHBOUR_OFFSETS[None, :, :]).ravel()  # 27 cells per point
+        unique_keys, inverse = np.unique(keys, return_inverse=True)
+        cell_keys, cell_points = [], []  # Stored points of each queried cell, found in all the runs
+        for run_keys, run_points in self.runs:
+            if len(run_keys) <= len(unique_keys):  # Small run, its keys are looked for among the queried cells
+                positions = np.minimum(np.searchsorted(unique_keys, run_keys), len(unique_keys) - 1)
+                hits = unique_keys[positions] == run_keys
+                cell_keys.append(positions[hits])
+                cell_points.append(run_points[hits])
+                continue
+            starts = np.searchsorted(run_keys, unique_keys, side="left")
+            hits = np.flatnonzero(run_keys[np.minimum(starts, len(run_keys) - 1)] == unique_keys)  # Most are empty
+            if not len(hits):
+                continue
+            starts = starts[hits]
+            counts = np.searchsorted(run_keys, unique_keys[hits], side="right") - starts
+            within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            cell_keys.append(np.repeat(hits, counts))
+            cell_points.append(run_points[np.repeat(starts, counts) + within])
+        if not cell_keys:
+            return found
+        cell_keys = np.concatenate(cell_keys)
+        order = np.argsort(cell_keys, kind="stable")  # Grouped by cell, as if there was a single run
+        cell_points = np.concatenate(cell_points)[order]
+        unique_counts = np.bincount(cell_keys, minlength=len(unique_keys))
+        unique_starts = np.cumsum(unique_counts) - unique_counts
+        inverse = inverse.ravel()
+        counts = unique_counts[inverse]
+        query = np.repeat(np.arange(len(keys)) // len(NEIGHBOUR_OFFSETS), counts)  # Query point of each pair
+        within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        points = cell_points[np.repeat(unique_starts[inverse], counts) + within]  # Stored point of each pair
+        diff = coords[query] - self.coords[points]
+        close = np.einsum("ij,ij->i", diff, diff) <= radius * radius
+        found[query[close]] = True
+        return found
+
+
+class PoseIndex(object):
+    """Hash index of the poses (position and orientation) of the placed chains. Each pose is stored under its chain id
+    and the grid cell of its center, with cells of side 2 * max_distance, so finding a pose at max_distance or less
+    only looks at the 8 cells on the query's side of each axis, whatever the number of chains. Orientations are pairs
+    of unit vectors, equal when their cosines are at least min_cosine."""
+    def __init__(self, max_distance, min_cosine):
+        self.max_distance = float(max_distance)
+        self.min_cosine = min_cosine
+        self.cells = dict()  # (chain id, cell): list of (center, axes, item)
+
+    def get_cell(self, center):
+        return tuple(np.floor(center / (2 * self.max_distance)).astype(np.int64).tolist())
+
+    def add(self, chain_id, center, axes, item):
+        self.cells.setdefault((chain_id, self.get_cell(center)), []).append((center, axes, item))
+
+    def find(self, chain_id, center, axes):
+        """Returns the item stored with an equal pose, or None if there isn't any"""
+        position = center / (2 * self.max_distance)
+        cell = np.floor(position)
+        x, y, z = cell.astype(np.int64).tolist()
+        dx, dy, dz = np.where(position - cell < 0.5, -1, 1).tolist()  # Neighbour cell the pose can be in
+        for cell_x in (x, x + dx):
+            for cell_y in (y, y + dy):
+                for cell_z in (z, z + dz):
+                    for other_center, other_axes, item in self.cells.get((chain_id, (cell_x, cell_y, cell_z)), ()):
+                        if ((other_center - center) ** 2).sum() <= self.max_distance ** 2 and \
+                                (other_axes * axes).sum(axis=1).min() >= self.min_cosine:
+                            return item
+        return None
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# coding=utf-8
+import numpy as np
+
+SYMMETRY_CONFIRMATIONS = 3  # Times the same operator has to relate two copies of a chain to be used
+ROTATION_STEP = 0.1  # Rounding of the rotation matrices of the operators
+TRANSLATION_STEP = 2.0  # Rounding (in Angstroms) of the translations of the operators
+
+
+def get_operator_key(rot, tran):
+    """Returns a hashable key of a quantized operator, so operators that only differ by rounding errors are equal"""
+    return tuple(np.round(rot / ROTATION_STEP).astype(np.int64).ravel().tolist()) + \
+        tuple(np.round(tran / TRANSLATION_STEP).astype(np.int64).tolist())
+
+
+class SymmetryDetector(object):
+    """Finds the symmetry operators of a macrocomplex while it is built. A symmetry operator (rot, tran) moves placed
+    chains onto other placed chains: a placement (R, t) becomes (R @ rot, t @ rot + tran). Each time a chain is added,
+    the operators that move the previous copies of its template onto it are counted (quantized), and an operator
+    counted SYMMETRY_CONFIRMATIONS times is confirmed. Cyclic, dihedral, icosahedral or helical operators are all found
+    the same way, as they relate several pairs of copies."""
+    def __init__(self, confirmations=SYMMETRY_CONFIRMATIONS):
+        self.confirmations = confirmations
+        self.counts = dict()  # Operator key: times seen
+        self.operators = []  # Confirmed operators, (rot, tran)
+        self.copies = dict()  # id(template): list of placements
+
+    def add(self, placement):
+        """Registers a placed chain without looking for operators (for the copies made by the operators)"""
+        self.copies.setdefault(id(placement.template), []).append(placement)
+
+    def observe(self, placement):
+        """Registers a placed chain and returns the list of operators confirmed by it (with their inverses)"""
+        previous = self.copies.get(id(placement.template), [])
+        new_operators = []
+        if previous:
+            rots = np.array([copy.rot for copy in previous])
+            trans = np.array([copy.tran for copy in previous])
+            op_rots = np.einsum("kji,jl->kil", rots, placement.rot)  # rot_copy^T @ rot_new, for all copies at once
+            op_trans = placement.tran - np.einsum("ki,kij->kj", trans, op_rots)
+            for rot, tran in zip(op_rots, op_trans):
+                if np.allclose(rot, np.identity(3), atol=ROTATION_STEP) and \
+                        np.linalg.norm(tran) < TRANSLATION_STEP:  # Not a symmetry, the same position
+                    continue
+                key = get_operator_key(rot, tran)
+                self.counts[key] = self.counts.get(key, 0) + 1
+                if self.counts[key] == self.confirmations:
+                    inverse = rot.T
+                    new_operators.append((rot, tran))
+                    new_operators.append((inverse, -np.dot(tran, inverse)))
+        self.add(placement)
+        self.operators.extend(new_operators)
+        return new_operators
+
+
+def apply_operators(placements, operators):
+    """Returns the rotations (k, 3, 3) and translations (k, 3) of the copies of every placement moved by every
+    operator (placements first), computed with a couple of stacked matrix products"""
+    rots = np.array([placement.rot for placement in placements])
+    trans = np.array([placement.tran for placement in placements])
+    op_rots = np.array([rot for rot, tran in operators])
+    op_trans = np.array([tran for rot, tran in operators])
+    new_rots = np.einsum("pij,ojk->poik", rots, op_rots).reshape(-1, 3, 3)
+    new_trans = (np.einsum("pj,ojk->pok", trans, op_rots) + op_trans[None, :, :]).reshape(-1, 3)
+    return new_rots, new_trans
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# coding=utf-8
+import base64
+import struct
+import zlib
+import numpy as np
+
+THUMBNAIL_SIZE = 300  # Width and height (in pixels) of the thumbnails
+TRACE_GAP = 8.0  # Maximum distance (in Angstroms) between two consecutive backbone atoms to join them (chain breaks)
+DEPTH_CUE = 0.65  # Fraction of the brightness lost by the farthest atoms
+CHAIN_COLORS = np.array([[51, 255, 51], [0, 255, 255], [255, 51, 204], [255, 255, 0], [255, 128, 128],
+                         [128, 128, 255], [255, 153, 0], [0, 204, 128], [191, 128, 255], [230, 230, 230],
+                         [255, 77, 77], [77, 166, 255]], dtype=np.float64)  # Cycled by chain number, like util.cbc
+
+
+def get_trace(macrocomplex):
+    """Returns the coordinates of the backbone atoms (CA and C1') of all the placed chains and the chain number of
+    each atom. Chains added while it runs (the model is being built in another thread) are left for the next one."""
+    placements = list(macrocomplex)
+    coords = [placement.get_backbone_coords() for placement in placements]
+    numbers = [np.full(len(chain_coords), number, dtype=np.int64) for number, chain_coords in enumerate(coords)]
+    if not coords:
+        return np.zeros((0, 3)), np.zeros(0, dtype=np.int64)
+    return np.concatenate(coords), np.concatenate(numbers)
+
+
+def render_thumbnail(macrocomplex, size=THUMBNAIL_SIZE):
+    """Returns a (size, size, 3) uint8 image of the backbone trace of a macrocomplex, seen along its thinnest
+    direction. Consecutive atoms of a chain are joined by lines sampled every pixel, each chain has its own color and
+    the farthest points are darker (depth cueing). Only the nearest point of each pixel is drawn."""
+    image = np.zeros((size, size, 3), dtype=np.uint8)
+    coords, numbers = get_trace(macrocomplex)
+    if len(coords) == 0:
+        return image
+    coords = coords - coords.mean(axis=0)
+    axes = np.linalg.svd(coords, full_matrices=False)[2] if len(coords) > 2 else np.identity(3)
+    view = np.dot(coords, axes.T)  # x, y along the two largest directions, z the depth
+    extent = np.abs(view[:, :2]).max()
+    scale = (size / 2 - 2) / extent if extent > 0 else 1.0
+    points = view * scale
+    # Segments between consecutive atoms of the same chain, without crossing chain breaks
+    joined = (numbers[1:] == numbers[:-1]) & \
+        (np.linalg.norm(coords[1:] - coords[:-1], axis=1) <= TRACE_GAP)
+    lone = np.ones(len(points), dtype=bool)  # Atoms without segments are drawn as points
+    lone[1:][joined] = False
+    lone[:-1][joined] = False
+    starts = np.concatenate([np.flatnonzero(joined), np.flatnonzero(lone)])
+    ends = starts + np.concatenate([np.ones(joined.sum(), dtype=np.int64), np.zeros(lone.sum(), dtype=np.int64)])
+    deltas = points[ends] - points[starts]
+    steps = np.ceil(np.abs(deltas[:, :2]).max(axis=1)).astype(np.int64) + 1
+    segment = np.repeat(np.arange(len(starts)), steps)
+    fraction = (np.arange(len(segment)) - np.repeat(np.cumsum(steps) - steps, steps)) / np.repeat(steps, steps)
+    samples = np.repeat(points[starts], steps, axis=0) + np.repeat(deltas, steps, axis=0) * fraction[:, None]
+    # Each sample covers 2x2 pixels, a depth buffer keeps the nearest sample of each pixel
+    columns = np.clip(np.floor(samples[:, 0] + size / 2).astype(np.int64), 0, size - 2)
+    rows = np.clip(np.floor(size / 2 - samples[:, 1]).astype(np.int64), 0, size - 2)
+    pixels = np.concatenate([(rows + dr) * size + columns + dc for dr in (0, 1) for dc in (0, 1)])
+    depth = np.tile(samples[:, 2], 4)
+    depth_buffer = np.full(size * size, -np.inf)
+    np.maximum.at(depth_buffer, pixels, depth)
+    nearest = depth == depth_buffer[pixels]
+    pixels, depth = pixels[nearest], depth[nearest]
+    sample_segment = np.tile(segment, 4)[nearest]
+    span = depth.max() - depth.min()
+    shade = 1 - DEPTH_CUE * ((depth.max() - depth) / span if span > 0 else 0)
+    colors = CHAIN_COLORS[numbers[starts[sample_segment]] % len(CHAIN_COLORS)] * np.reshape(shade, (-1, 1))
+    image.reshape(-1, 3)[pixels] = colors.astype(np.uint8)
+    return image
+
+
+def encode_png(image):
+    """Returns the PNG file content of an RGB uint8 image"""
+    height, width = image.shape[:2]
+    raw = np.concatenate([np.zeros((height, 1), dtype=np.uint8), image.reshape(height, -1)], axis=1).tobytes()
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)) + \
+        chunk(b"IDAT", zlib.compress(raw, 1)) + chunk(b"IEND", b"")
+
+
+def get_thumbnail_data(macrocomplex, size=THUMBNAIL_SIZE):
+    """Returns the thumbnail of a macrocomplex as base64 PNG, the data a tkinter PhotoImage can load"""
+    return base64.b64encode(encode_png(render_thumbnail(macrocomplex, size))).decode("ascii")
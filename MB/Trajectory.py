@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# coding=utf-8
+import json
+import os
+import numpy as np
+from MB.CustomPDB import ChainPlacement, MacroComplex
+
+TRAJECTORY_VERSION = 1
+
+
+def get_template_source(template):
+    """Returns the [input file path, chain number inside the file] of a template chain"""
+    model = template.parent
+    return [model.xtra.get("path", model.xtra.get("file")), template.xtra["number"]]
+
+
+class TrajectoryWriter(object):
+    """Append-only log of how a model is built. The first line is a header, and each next line is one added chain:
+    the input chain used as template, the rotation and translation that place it, the chain it was placed from and
+    the interaction used. Each step only writes its own chain, so the log grows linearly with the model. If steps is
+    given, the log of a resumed model is continued after its header and first steps (the later ones are dropped)."""
+    def __init__(self, path, model_id, seed=None, steps=None):
+        self.path = path
+        lines = []
+        if steps is not None and os.path.exists(path):
+            with open(path) as fh:
+                lines = fh.readlines()[:steps + 1]
+        self.fh = open(path, "w")
+        if lines:
+            self.fh.writelines(lines)
+            self.fh.flush()
+            self.steps = len(lines) - 1
+        else:
+            self.steps = 0
+            self.write({"version": TRAJECTORY_VERSION, "model": model_id, "seed": seed})
+
+    def write(self, record):
+        self.fh.write(json.dumps(record) + "\n")
+        self.fh.flush()  # The log is useful even if the build doesn't finish
+
+    def add(self, placement, parent=None, interaction=None):
+        """Appends a placed chain. parent is the placement it was superimposed on and interaction the residues of
+        parent that interact with it"""
+        self.steps += 1
+        self.write({"step": self.steps,
+                    "chain": placement.id,
+                    "template": get_template_source(placement.template),
+                    "rot": placement.rot.ravel().tolist(),
+                    "tran": placement.tran.tolist(),
+                    "parent": None if parent is None else parent.number,
+                    "interaction": None if interaction is None else list(interaction)})
+
+    def close(self):
+        self.fh.close()
+
+
+def read_trajectory(path):
+    """Reads a trajectory log and returns its header and the list of steps"""
+    with open(path) as fh:
+        records = [json.loads(line) for line in fh if line.strip()]
+    return records[0], records[1:]
+
+
+def get_trajectory_directory(steps):
+    """Returns the input directory of the templates of a trajectory"""
+    for step in steps:
+        if os.path.dirname(step["template"][0]):
+            return os.path.dirname(step["template"][0]) + "/"
+    return None
+
+
+def replay_trajectory(steps, pdbmodels, last_step=None, model_id="Model"):
+    """Returns the MacroComplex at the given step of a trajectory (the last one if not given). pdbmodels are the
+    input models as returned by unify_ids, where the templates are looked up by file name and chain number"""
+    templates = dict()
+    for model in pdbmodels:
+        file_name = os.path.basename(model.xtra.get("path", model.xtra.get("file", "")))
+        for number, chain in enumerate(model):
+            templates[(file_name, number)] = chain
+    macrocomplex = MacroComplex(model_id)
+    for step in steps:
+        if last_step is not None and step["step"] > last_step:
+            break
+        template = templates[(os.path.basename(step["template"][0]), step["template"][1])]
+        macrocomplex.add(ChainPlacement(template, np.array(step["rot"]).reshape(3, 3), np.array(step["tran"])))
+    return macrocomplex
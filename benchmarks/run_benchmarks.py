@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""Stage level benchmark of MacrocomplexBuilder over the bundled examples. Each example is built in a new process
+with a fixed seed, timing every step of build_macrocomplex and recording the peak memory. Results are written as
+JSON and compared with a stored baseline: if a stage is slower (or the memory bigger) than the tolerance allows, or a
+model doesn't have the same number of chains, the script exits with an error."""
+from argparse import ArgumentParser
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+EXAMPLES = ["enterovirus", "nucleosome", "proteasoma", "microtuble", "hemo", "phosphate"]
+STAGES = ["read_pdbs", "unify_ids", "get_interaction_dict", "remove_redundant_interactions", "get_interaction_graph",
+          "main_loop", "score_models", "save_results"]
+BENCHMARK_SEED = 1
+DEFAULT_BASELINE = os.path.join(ROOT, "benchmarks", "baseline.json")
+
+
+def get_peak_memory():
+    """Returns the peak resident memory of the process in KB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":  # macOS gives it in bytes
+        peak //= 1024
+    return peak
+
+
+def benchmark_example(example, max_chains, num_models):
+    """Builds one example timing each stage. It runs in its own process, so the peak memory is only this build's"""
+    from MB import MacroB
+    from MB.BuildSettings import BuildSettings
+    directory = os.path.join(ROOT, "examples", example) + "/"
+    times = dict()
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp_dir, open(os.devnull, "w") as devnull:
+        os.chdir(tmp_dir)  # Models are saved in a temporary directory
+        try:
+            with contextlib.redirect_stdout(devnull):
+                start = time.perf_counter()
+                pdbmodels = MacroB.read_pdbs(directory)
+                times["read_pdbs"] = time.perf_counter() - start
+                start = time.perf_counter()
+                MacroB.unify_ids(pdbmodels)
+                times["unify_ids"] = time.perf_counter() - start
+                start = time.perf_counter()
+                interaction_dict = MacroB.get_interaction_dict(pdbmodels)
+                times["get_interaction_dict"] = time.perf_counter() - start
+                start = time.perf_counter()
+                MacroB.remove_redundant_interactions(interaction_dict)
+                times["remove_redundant_interactions"] = time.perf_counter() - start
+                start = time.perf_counter()
+                interaction_graph = MacroB.get_interaction_graph(interaction_dict)
+                times["get_interaction_graph"] = time.perf_counter() - start
+                start = time.perf_counter()
+                settings = BuildSettings(example, num_models, max_chains, seed=BENCHMARK_SEED)
+                models = MacroB.main_loop(interaction_graph, settings)
+                times["main_loop"] = time.perf_counter() - start
+                start = time.perf_counter()
+                interacting_ids = interaction_graph.get_interacting_ids()
+                MacroB.rank_models([MacroB.score_model(model, interacting_ids) for model in models])
+                times["score_models"] = time.perf_counter() - start
+                start = time.perf_counter()
+                MacroB.save_results(models, example)
+                times["save_results"] = time.perf_counter() - start
+        finally:
+            os.chdir(cwd)
+    return {"stages": times,
+            "total": sum(times.values()),
+            "peak_memory_kb": get_peak_memory(),
+            "chains": [len(model) for model in models]}
+
+
+def run_benchmarks(examples, max_chains, num_models, repeat):
+    """Runs every example repeat times (each in a new process) and keeps the fastest time of each stage"""
+    context = multiprocessing.get_context("spawn")  # Fresh processes, nothing shared between examples
+    results = dict()
+    for example in examples:
+        runs = []
+        for _ in range(repeat):
+            with context.Pool(1) as pool:
+                runs.append(pool.apply(benchmark_example, (example, max_chains, num_models)))
+        best = {"stages": {stage: min(run["stages"][stage] for run in runs) for stage in STAGES},
+                "peak_memory_kb": min(run["peak_memory_kb"] for run in runs),
+                "chains": runs[0]["chains"]}
+        best["total"] = sum(best["stages"].values())
+        results[example] = best
+        print("%-12s total %8.3f s  peak %8d KB  chains %s" % (example, best["total"], best["peak_memory_kb"],
+                                                                best["chains"]))
+        for stage in STAGES:
+            print("    %-26s %8.3f s" % (stage, best["stages"][stage]))
+    return results
+
+
+def compare_results(results, baseline, time_tolerance, memory_tolerance, min_seconds):
+    """Returns a list of regression messages comparing the results with the baseline ones. Stages faster than
+    min_seconds in the baseline are too noisy to compare only relatively, so they also need to be min_seconds slower"""
+    regressions = []
+    for example, result in results.items():
+        if example not in baseline:
+            continue
+        reference = baseline[example]
+        if result["chains"] != reference["chains"]:
+            regressions.append("%s: models have %s chains, baseline had %s" % (example, result["chains"],
+                                                                               reference["chains"]))
+        for stage in STAGES:
+            if stage not in reference["stages"]:  # Added after the baseline was stored
+                continue
+            new_time, old_time = result["stages"][stage], reference["stages"][stage]
+            if new_time > old_time * (1 + time_tolerance) and new_time - old_time > min_seconds:
+                regressions.append("%s: %s took %.3f s, baseline %.3f s" % (example, stage, new_time, old_time))
+        if result["peak_memory_kb"] > reference["peak_memory_kb"] * (1 + memory_tolerance):
+            regressions.append("%s: peak memory %d KB, baseline %d KB" % (example, result["peak_memory_kb"],
+                                                                           reference["peak_memory_kb"]))
+    return regressions
+
+
+parser = ArgumentParser(description="Benchmarks each stage of MacrocomplexBuilder over the bundled examples")
+parser.add_argument("examples", nargs="*", default=EXAMPLES, help="Examples to run (all by default)")
+parser.add_argument("-c", dest="max_chains", type=int, default=100, help="Maximum number of chains of each model")
+parser.add_argument("-n", dest="num_models", type=int, default=1, help="Number of models of each example")
+parser.add_argument("-r", "--repeat", dest="repeat", type=int, default=1,
+                    help="Runs of each example, the fastest time of each stage is kept")
+parser.add_argument("-o", dest="output", default=None, help="JSON file where results are written")
+parser.add_argument("-b", "--baseline", dest="baseline", default=DEFAULT_BASELINE, help="Baseline JSON file")
+parser.add_argument("--update-baseline", dest="update_baseline", action="store_true", default=False,
+                    help="Stores these results as the new baseline instead of comparing with it")
+parser.add_argument("--time-tolerance", dest="time_tolerance", type=float, default=0.25,
+                    help="Fraction a stage can be slower than the baseline")
+parser.add_argument("--memory-tolerance", dest="memory_tolerance", type=float, default=0.25,
+                    help="Fraction the peak memory can be bigger than the baseline")
+parser.add_argument("--min-seconds", dest="min_seconds", type=float, default=0.2,
+                    help="Slowdowns smaller than this are never regressions")
+
+if __name__ == "__main__":
+    options = parser.parse_args()
+    results = run_benchmarks(options.examples, options.max_chains, options.num_models, options.repeat)
+    report = {"machine": {"platform": platform.platform(), "python": platform.python_version(),
+                          "cpus": os.cpu_count()},
+              "settings": {"max_chains": options.max_chains, "num_models": options.num_models,
+                           "seed": BENCHMARK_SEED},
+              "results": results}
+    if options.output:
+        with open(options.output, "w") as fh:
+            json.dump(report, fh, indent=2)
+    if options.update_baseline:
+        if os.path.exists(options.baseline):  # Keeps the examples that were not run this time
+            with open(options.baseline) as fh:
+                old_report = json.load(fh)
+            if old_report["settings"] == report["settings"]:
+                report["results"] = dict(old_report["results"], **results)
+        with open(options.baseline, "w") as fh:
+            json.dump(report, fh, indent=2)
+        print("Baseline written to %s" % options.baseline)
+        sys.exit(0)
+    if not os.path.exists(options.baseline):
+        sys.stderr.write("There is no baseline at %s, create it with --update-baseline\n" % options.baseline)
+        sys.exit(1)
+    with open(options.baseline) as fh:
+        baseline = json.load(fh)
+    if baseline["settings"] != report["settings"]:
+        sys.stderr.write("The baseline was run with other settings (%s), results can't be compared\n" %
+                         baseline["settings"])
+        sys.exit(1)
+    regressions = compare_results(results, baseline["results"], options.time_tolerance, options.memory_tolerance,
+                                  options.min_seconds)
+    if regressions:
+        sys.stderr.write("PERFORMANCE REGRESSIONS:\n" + "".join("  %s\n" % line for line in regressions))
+        sys.exit(1)
+    print("No regressions against %s" % options.baseline)
@@ -17,5 +17,5 @@ setup(
                 "Programming Language :: Python :: 3",
 	              "License :: OSI Approved :: MIT License",
                 "Operating System :: OS Independent"],
-    scripts=["MB/MBlauncher.py" , "MB/MB_GUI.py"]
+    scripts=["MB/MBlauncher.py" , "MB/MB_GUI.py", "MB/MBreplay.py", "MB/MBservice.py"]
 )